@@ -1,18 +1,42 @@
 """File to download example sky images from flickr."""
 from __future__ import print_function, division
-import socket
-socket.setdefaulttimeout(10)
 import urllib.request as urllib
+import argparse
+import http.client
 import os
+import tempfile
+import threading
 import time
 import re
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urljoin, urlsplit
+
+try:
+    from utils.instrument import image_context, timed
+except ImportError:
+    # Run as a script from data/, without the repository root on the path: no metrics
+    from contextlib import nullcontext as image_context
+
+    def timed(name):
+        return lambda function: function
 
 FILE_DIR = os.path.dirname(os.path.realpath(__file__))
 WRITE_TO_BASE_DIR = os.path.join(FILE_DIR, "downloaded")
 PATTERN = re.compile(r"_z\.jpg$")
 URLS_LIST_FILEPATH = os.path.join(WRITE_TO_BASE_DIR, "_urls.txt")
 
+HEADERS = {'User-Agent': 'Chrome/66.0.3359.181'}
+# Errors of a request sent on a kept-alive connection the server has closed meanwhile
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+# Bodies are streamed to disk in chunks of this size
+CHUNK_SIZE = 64 * 1024
+MAX_REDIRECTS = 5
+# Seconds before a connection or read gives up, passed per request instead of through
+# socket.setdefaulttimeout so importing this module leaves the process untouched
+TIMEOUT = 10
+
 # List of URLs that have images of skies
 ERIC_CHAN_SKY_SERIES = ["https://ericcahan.com/portfolio/sky-series/", "https://ericcahan.com/uncategorized/horizontals/"]
 
@@ -72,7 +96,7 @@ def load_page_source(main_url):
     url = main_url
     headers = {'User-Agent': 'Chrome/66.0.3359.181'}
     req = urllib.Request(url, headers=headers)
-    lines = urllib.urlopen(req).readlines()
+    lines = urllib.urlopen(req, timeout=TIMEOUT).readlines()
     content = " "
     if len(lines) == 0:
         raise Exception("No data received from %s" % (url,))
@@ -119,6 +143,14 @@ def fix_url(url):
     else:
         return url
 
+def image_filepath(source_url, dest_dir, name):
+    """Returns the path an image is saved to, or None if its URL is not a downloadable jpg."""
+    if "/" not in source_url or (".jpg" not in source_url and ".jpeg" not in source_url) or "?" in source_url:
+        return None
+    file_type = source_url[source_url.rfind("."):].lower()
+    return os.path.join(dest_dir, name + file_type)
+
+@timed("fetch.download")
 def download_image(source_url, dest_dir, urls_list_file, name):
     """Downloads an image from flickr and saves it.
     Images that were already downloaded are skipped automatically.
@@ -132,15 +164,11 @@ def download_image(source_url, dest_dir, urls_list_file, name):
         True if the image was downloaded
         False otherwise (including images that were skipped)
     """
-    if "/" not in source_url or (".jpg" not in source_url and ".jpeg" not in source_url) or "?" in source_url:
+    filepath = image_filepath(source_url, dest_dir, name)
+    if filepath is None:
         print("[Warning] source url '%s' is invalid" % (source_url))
         return False
     else:
-        # index = source_url.rfind(".com/")
-        file_type = source_url[source_url.rfind("."):].lower()
-        # image_name = source_url[index+len(".com/"):].replace("/", "-")
-        # image_name = image_name.replace("wp-content-uploads-", "-")
-        filepath = os.path.join(dest_dir, name + file_type)
         if os.path.isfile(filepath):
             print("[Info] skipped '%s', already downloaded" % (filepath))
             return False
@@ -154,12 +182,266 @@ def download_image(source_url, dest_dir, urls_list_file, name):
             # download the image
             headers = {'User-Agent': 'Chrome/66.0.3359.181'}
             req = urllib.Request(source_url, headers=headers)
-            res = urllib.urlopen(req)
+            res = urllib.urlopen(req, timeout=TIMEOUT)
             f = open(filepath, "wb")
             f.write(res.read())
             f.close()
             # urllib.urlretrieve(source_url, filepath)
             return True
 
+
+class TokenBucket(object):
+    """Rate limiter: `rate` requests per second on average, bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Taking the token before sleeping reserves a slot, so waiting callers queue up
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP(S) connections with a concurrency limit and a token bucket per host."""
+
+    def __init__(self, per_host=4, rate=5.0, timeout=TIMEOUT):
+        self.per_host = per_host
+        self.rate = rate
+        self.timeout = timeout
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def _host(self, key):
+        with self.lock:
+            if key not in self.hosts:
+                self.hosts[key] = {
+                    "slots": threading.BoundedSemaphore(self.per_host),
+                    "bucket": TokenBucket(self.rate, capacity=self.per_host),
+                    "idle": [],
+                }
+            return self.hosts[key]
+
+    @contextmanager
+    def connection(self, scheme, netloc):
+        """Yields (connection to scheme://netloc, whether it was kept alive from an earlier request).
+        The connection is returned to the pool if the block succeeds."""
+        host = self._host((scheme, netloc))
+        with host["slots"]:
+            host["bucket"].acquire()
+            with self.lock:
+                conn = host["idle"].pop() if host["idle"] else None
+            reused = conn is not None
+            if conn is None:
+                conn_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+                conn = conn_class(netloc, timeout=self.timeout)
+            try:
+                yield conn, reused
+            except BaseException:
+                conn.close()
+                raise
+            with self.lock:
+                host["idle"].append(conn)
+
+    def get(self, url, handle_body, redirects=MAX_REDIRECTS):
+        """Sends a GET request and passes the response to handle_body(response).
+        The whole body must be consumed by handle_body so the connection can be reused.
+        Returns:
+            The value returned by handle_body
+        """
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        with self.connection(parts.scheme, parts.netloc) as (conn, reused):
+            try:
+                conn.request("GET", path, headers=HEADERS)
+                res = conn.getresponse()
+            except STALE_CONNECTION_ERRORS:
+                # A kept-alive connection may have been closed by the server, retry once on a fresh one.
+                # Anything else, or any error on a new connection (e.g. a timeout), is not retried
+                if not reused:
+                    raise
+                conn.close()
+                conn.request("GET", path, headers=HEADERS)
+                res = conn.getresponse()
+            if res.status in (301, 302, 303, 307, 308) and redirects > 0:
+                location = res.getheader("Location")
+                res.read()
+                redirect = urljoin(url, location)
+            elif res.status != 200:
+                res.read()
+                raise IOError("HTTP %d for %s" % (res.status, url))
+            else:
+                return handle_body(res)
+        return self.get(redirect, handle_body, redirects - 1)
+
+    def close(self):
+        with self.lock:
+            for host in self.hosts.values():
+                for conn in host["idle"]:
+                    conn.close()
+                host["idle"] = []
+
+
+def fetch_page_source(pool, url):
+    """Load the source code of a page through a connection pool.
+    Returns:
+        Html content
+    """
+    content = pool.get(url, lambda res: res.read())
+    if len(content) == 0:
+        raise Exception("No data received from %s" % (url,))
+    return content.decode("utf-8")
+
+
+@timed("fetch.download")
+def stream_to_file(pool, source_url, filepath):
+    """Downloads source_url into filepath.
+    The body is streamed in chunks into a temporary file next to filepath,
+    which is renamed over filepath once complete, so an interrupted run never
+    leaves a truncated image behind.
+    """
+    dest_dir = os.path.dirname(filepath)
+
+    def handle_body(res):
+        fd, tmp_path = tempfile.mkstemp(dir=dest_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = res.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    pool.get(source_url, handle_body)
+
+
+def load_downloaded_urls(urls_list_filepath=URLS_LIST_FILEPATH):
+    """Reads the "<URL>\t<Image-Filepath>" lines of a previous run.
+    Returns:
+        Set of the URLs whose image file still exists
+    """
+    done = set()
+    if not os.path.isfile(urls_list_filepath):
+        return done
+    with open(urls_list_filepath) as furl:
+        for line in furl:
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) == 2 and os.path.isfile(parts[1]):
+                done.add(parts[0])
+    return done
+
+
+def fetch_images(jobs, urls_list_filepath=URLS_LIST_FILEPATH, workers=8, per_host=4, rate=5.0, pool=None):
+    """Downloads images concurrently.
+    Images listed in urls_list_filepath (or already on disk) are skipped, so an
+    interrupted run resumes where it stopped.
+    Args:
+        jobs Iterable of (source_url, dest_dir, name) tuples, as for download_image
+        urls_list_filepath File that records "<URL>\t<Image-Filepath>" for every finished image
+        workers Number of download threads
+        per_host Maximum number of concurrent connections per host
+        rate Maximum number of requests per second per host
+        pool Optional ConnectionPool to share with other requests
+    Returns:
+        Number of images downloaded
+    """
+    own_pool = pool is None
+    if own_pool:
+        pool = ConnectionPool(per_host=per_host, rate=rate)
+    done = load_downloaded_urls(urls_list_filepath)
+    lock = threading.Lock()
+
+    def fetch(job):
+        source_url, dest_dir, name = job
+        filepath = image_filepath(source_url, dest_dir, name)
+        if filepath is None:
+            print("[Warning] source url '%s' is invalid" % (source_url))
+            return False
+        if source_url in done or os.path.isfile(filepath):
+            return False
+        try:
+            with image_context(os.path.basename(filepath)):
+                # The temporary .part file is created in dest_dir, so it must exist first
+                os.makedirs(dest_dir, exist_ok=True)
+                stream_to_file(pool, source_url, filepath)
+        except Exception as exc:
+            print("[Error] %s: %s" % (source_url, exc))
+            return False
+        with lock:
+            furl.write("%s\t%s\n" % (source_url, filepath))
+            furl.flush()
+        return True
+
+    urls_dir = os.path.dirname(urls_list_filepath)
+    if urls_dir and not os.path.exists(urls_dir):
+        os.makedirs(urls_dir)
+    try:
+        with open(urls_list_filepath, "a") as furl, ThreadPoolExecutor(workers) as executor:
+            return sum(executor.map(fetch, jobs))
+    finally:
+        if own_pool:
+            pool.close()
+
+
+def main_concurrent(pages=ERIC_CHAN_SKY_SERIES, base_dir=WRITE_TO_BASE_DIR, workers=8, per_host=4, rate=5.0):
+    """Concurrent version of main: pages and images share a pool of keep-alive connections,
+    and a per-host token bucket replaces the fixed sleeps."""
+    pool = ConnectionPool(per_host=per_host, rate=rate)
+    jobs = []
+    for url in pages:
+        host = re.findall(r"//[^/]*", url)[0][2:-4]
+        dest_dir = os.path.join(base_dir, "%s/" % (host,))
+        try:
+            source = fetch_page_source(pool, url)
+        except Exception as exc:
+            traceback.print_exc()
+            print(exc)
+            continue
+        for image in extract_image_urls(source):
+            jobs.append((fix_url(image["src"]), dest_dir, image["alt"]))
+        if not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+
+    print("Downloading %d images" % (len(jobs),))
+    try:
+        downloaded = fetch_images(jobs, os.path.join(base_dir, "_urls.txt"), workers=workers, pool=pool)
+    finally:
+        pool.close()
+    print("Downloaded %d new images" % (downloaded,))
+    return downloaded
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("pages", nargs="*", default=ERIC_CHAN_SKY_SERIES, help="pages to collect images from")
+    parser.add_argument("--out", default=WRITE_TO_BASE_DIR, help="base download directory")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--per-host", type=int, default=4, help="concurrent connections per host")
+    parser.add_argument("--rate", type=float, default=5.0, help="requests per second per host")
+    parser.add_argument("--serial", action="store_true", help="download one image at a time (previous behaviour)")
+    args = parser.parse_args(argv)
+    if args.serial:
+        main()
+    else:
+        main_concurrent(args.pages, args.out, args.workers, args.per_host, args.rate)
+
+
 if __name__ == "__main__":
-    main()
+    cli()
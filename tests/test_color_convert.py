@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from utils.color_convert import delta_e, lab2rgb, rgb2lab
+
+color = pytest.importorskip("skimage.color")
+
+# Largest CIE76 difference allowed against skimage, the kernel computes in float32
+MAX_DELTA_E = 1e-3
+# Largest 0-1 RGB difference allowed for lab2rgb, a small fraction of one 8-bit step
+MAX_RGB_ERROR = 1e-4
+
+
+@pytest.fixture(scope="module")
+def cube():
+    # Every third level of each channel plus 255, about 660k colors including all corners and edges
+    levels = np.unique(np.append(np.arange(0, 256, 3), 255)).astype(np.uint8)
+    return np.stack(np.meshgrid(levels, levels, levels, indexing="ij"), axis=-1).reshape(-1, 1, 3)
+
+
+def test_rgb2lab_uint8_cube(cube):
+    assert delta_e(rgb2lab(cube), color.rgb2lab(cube)).max() < MAX_DELTA_E
+
+
+def test_rgb2lab_float_cube(cube):
+    rgb = cube / 255
+    assert delta_e(rgb2lab(rgb), color.rgb2lab(rgb)).max() < MAX_DELTA_E
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.int32, np.int64])
+def test_rgb2lab_integer_dtypes_scale_by_dtype_max(cube, dtype):
+    # Same meaning as skimage's img_as_float: 16-bit PNGs are 0-65535
+    rgb = cube.astype(dtype) * (np.iinfo(dtype).max // 255)
+    assert delta_e(rgb2lab(rgb), color.rgb2lab(rgb)).max() < MAX_DELTA_E
+
+
+def test_rgb2lab_chunks_and_shape(cube):
+    image = cube[:6400].reshape(100, 64, 3)
+    lab = rgb2lab(image, chunk_size=1000)
+    assert lab.shape == image.shape
+    assert lab.dtype == np.float32
+    np.testing.assert_array_equal(lab, rgb2lab(image))
+
+
+def test_lab2rgb_cube(cube):
+    lab = color.rgb2lab(cube)
+    assert np.abs(lab2rgb(lab) - color.lab2rgb(lab)).max() < MAX_RGB_ERROR
+
+
+def test_round_trip(cube):
+    assert np.abs(lab2rgb(rgb2lab(cube)) * 255 - cube).max() < 0.5
+
+
+def test_lab2rgb_clips_out_of_gamut_colors():
+    rgb = lab2rgb(np.array([[50.0, 120.0, -120.0], [100.0, -128.0, 127.0]]))
+    assert rgb.min() >= 0 and rgb.max() <= 1
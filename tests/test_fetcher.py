@@ -0,0 +1,137 @@
+import http.client
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from data.fetcher import ConnectionPool, fetch_images, load_downloaded_urls
+
+IMAGES = {
+    "/a.jpg": b"first image" * 1000,
+    "/b.jpg": b"second image" * 1000,
+    "/c.jpg": b"third image" * 1000,
+}
+REDIRECTS = {"/moved.jpg": "/b.jpg"}
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the connection open between requests
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections.append(self.client_address)
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path in REDIRECTS:
+            self.send_response(302)
+            self.send_header("Location", REDIRECTS[self.path])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = IMAGES.get(self.path)
+        if body is None:
+            body = b"not found"
+            self.send_response(404)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.server.drop_connections:
+            # Closes the kept-alive connection without telling the client, as idle timeouts do
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+    httpd.connections = []
+    httpd.requests = []
+    httpd.drop_connections = False
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def url(server, path):
+    return "http://127.0.0.1:%d%s" % (server.server_address[1], path)
+
+
+def fetch(server, tmp_path, paths, workers=1):
+    # dest_dir does not exist yet, fetch_images must create it
+    dest_dir = str(tmp_path / "images" / "host")
+    jobs = [(url(server, path), dest_dir, os.path.splitext(path[1:])[0]) for path in paths]
+    downloaded = fetch_images(jobs, str(tmp_path / "_urls.txt"), workers=workers, per_host=1, rate=1000)
+    return downloaded, dest_dir
+
+
+def test_downloads_into_new_directory_over_one_connection(server, tmp_path):
+    downloaded, dest_dir = fetch(server, tmp_path, ["/a.jpg", "/b.jpg", "/c.jpg"])
+
+    assert downloaded == 3
+    for path, body in IMAGES.items():
+        with open(os.path.join(dest_dir, path[1:]), "rb") as f:
+            assert f.read() == body
+    assert len(server.connections) == 1
+    assert not [name for name in os.listdir(dest_dir) if name.endswith(".part")]
+
+
+def test_follows_redirects(server, tmp_path):
+    downloaded, dest_dir = fetch(server, tmp_path, ["/moved.jpg"])
+
+    assert downloaded == 1
+    assert server.requests == ["/moved.jpg", "/b.jpg"]
+    with open(os.path.join(dest_dir, "moved.jpg"), "rb") as f:
+        assert f.read() == IMAGES["/b.jpg"]
+
+
+def test_missing_image_is_skipped(server, tmp_path):
+    downloaded, dest_dir = fetch(server, tmp_path, ["/missing.jpg", "/a.jpg"])
+
+    assert downloaded == 1
+    assert os.listdir(dest_dir) == ["a.jpg"]
+    assert load_downloaded_urls(str(tmp_path / "_urls.txt")) == {url(server, "/a.jpg")}
+
+
+def test_resume_skips_finished_images(server, tmp_path):
+    assert fetch(server, tmp_path, ["/a.jpg", "/b.jpg"])[0] == 2
+    del server.requests[:]
+
+    downloaded, dest_dir = fetch(server, tmp_path, ["/a.jpg", "/b.jpg", "/c.jpg"], workers=2)
+
+    assert downloaded == 1
+    assert server.requests == ["/c.jpg"]
+    assert sorted(os.listdir(dest_dir)) == ["a.jpg", "b.jpg", "c.jpg"]
+
+
+def test_retries_once_when_kept_alive_connection_was_closed(server):
+    server.drop_connections = True
+    pool = ConnectionPool(per_host=1, rate=1000)
+    try:
+        assert pool.get(url(server, "/a.jpg"), lambda res: res.read()) == IMAGES["/a.jpg"]
+        assert pool.get(url(server, "/b.jpg"), lambda res: res.read()) == IMAGES["/b.jpg"]
+    finally:
+        pool.close()
+    assert len(server.connections) == 2
+
+
+def test_new_connection_errors_are_not_retried(monkeypatch):
+    attempts = []
+
+    def connect(conn):
+        attempts.append(conn.host)
+        raise ConnectionResetError("refused")
+
+    monkeypatch.setattr(http.client.HTTPConnection, "connect", connect)
+    pool = ConnectionPool(per_host=1, rate=1000)
+    with pytest.raises(ConnectionResetError):
+        pool.get("http://127.0.0.1:9/a.jpg", lambda res: res.read())
+    assert attempts == ["127.0.0.1"]
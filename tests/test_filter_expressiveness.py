@@ -0,0 +1,39 @@
+import json
+
+import numpy as np
+import pytest
+
+from utils import instrument
+from utils.filter_expressiveness import iter_expressiveness, score_image
+
+Image = pytest.importorskip("PIL.Image")
+
+
+@pytest.fixture
+def images_dir(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    Image.fromarray(rng.integers(0, 256, (16, 16, 3), dtype=np.uint8)).save(str(tmp_path / "small.png"))
+    Image.fromarray(rng.integers(0, 256, (64, 64, 3), dtype=np.uint8)).save(str(tmp_path / "huge.png"))
+    # PIL refuses images over twice this many pixels with a DecompressionBombError
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    return tmp_path
+
+
+def test_decompression_bomb_is_skipped_and_recorded(images_dir):
+    metrics = str(images_dir / "metrics.jsonl")
+    instrument.enable(metrics)
+    try:
+        scores = dict(iter_expressiveness(str(images_dir), workers=1, max_size=None))
+    finally:
+        instrument.disable()
+
+    assert list(scores) == ["small.png"]
+    with open(metrics) as f:
+        records = {record["image"]: record for record in map(json.loads, f) if "image" in record}
+    assert "DecompressionBombError" in records["huge.png"]["error"]
+    assert "error" not in records["small.png"]
+
+
+def test_score_image_returns_none_for_decompression_bomb(images_dir):
+    assert score_image(str(images_dir / "huge.png")) is None
+    assert score_image(str(images_dir / "small.png")) > 0
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import pytest
+
+from utils.filter_expressiveness import open_reduced, score_image
+from utils.image_cache import ImageCache, decode_image
+
+Image = pytest.importorskip("PIL.Image")
+
+
+@pytest.fixture(scope="module")
+def jpeg(tmp_path_factory):
+    y, x = np.mgrid[0:900, 0:1200]
+    rgb = np.stack([x * 255 // 1200, y * 255 // 900, (x + y) % 256], axis=-1).astype(np.uint8)
+    path = str(tmp_path_factory.mktemp("images") / "sky.jpg")
+    Image.fromarray(rgb).save(path, quality=90)
+    return path
+
+
+@pytest.mark.parametrize("max_size", [None, 512, 300])
+def test_cache_decodes_like_open_reduced(jpeg, tmp_path, max_size):
+    expected = np.asarray(open_reduced(jpeg, max_size))
+    assert max(expected.shape[:2]) <= (max_size or 1200)
+
+    for cache in (ImageCache(), ImageCache(disk_dir=str(tmp_path))):
+        decoded = cache.get(jpeg, max_size)
+        assert decoded.rgb.dtype == np.uint8
+        np.testing.assert_array_equal(decoded.rgb, expected)
+        np.testing.assert_array_equal(decoded.lab, decode_image(jpeg, max_size).lab)
+
+
+def test_score_is_the_same_with_and_without_cache(jpeg, tmp_path):
+    assert score_image(jpeg, 512, str(tmp_path)) == score_image(jpeg, 512)
+
+
+def test_disk_cache_keeps_one_decode_per_size(jpeg, tmp_path):
+    ImageCache(disk_dir=str(tmp_path)).get(jpeg, 512)
+    ImageCache(disk_dir=str(tmp_path)).get(jpeg)
+    cache = ImageCache(disk_dir=str(tmp_path))
+    assert isinstance(cache.get(jpeg, 512).rgb, np.memmap)
+    assert sorted(name.split("-")[1] for name in os.listdir(str(tmp_path))) == \
+        ["512.lab.npy", "512.rgb.npy", "full.lab.npy", "full.rgb.npy"]
+
+
+def test_lru_keeps_latest_decode_larger_than_max_bytes(jpeg):
+    cache = ImageCache(max_bytes=1)
+    first = cache.get(jpeg)
+    assert cache.get(jpeg) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.get(jpeg, 512)
+    assert len(cache.entries) == 1
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from utils.color_convert import rgb2lab
+from utils.palette_format import PackedPalettes, palette_array, write_packed, write_sharded
+from utils.palette_store import shard_of
+
+# Largest difference from the source colors allowed per dtype and space:
+# float16 keeps 11 significant bits, uint8 LAB stores L in steps of 100/255 and a, b in steps of 1
+TOLERANCE = {
+    ("uint8", "rgb"): 0.5,
+    ("float16", "rgb"): 0.125,
+    ("uint8", "lab"): 0.5,
+    ("float16", "lab"): 0.07,
+}
+
+
+def random_palette(rng, n):
+    return [{"r": r, "g": g, "b": b} for r, g, b in rng.uniform(0, 255, (n, 3)).round(2)]
+
+
+@pytest.fixture(scope="module")
+def palettes():
+    rng = np.random.default_rng(0)
+    palettes = {"sky-%d.jpg" % i: random_palette(rng, n) for i, n in enumerate([10, 1, 7, 3, 10])}
+    palettes["empty.jpg"] = []
+    palettes["ciel étoilé.png"] = random_palette(rng, 5) + [{"r": 0, "g": 0, "b": 0}, {"r": 255, "g": 255, "b": 255}]
+    return palettes
+
+
+def expected_colors(palette, space):
+    rgb = palette_array(palette)
+    return rgb2lab(rgb / 255).astype(np.float64) if space == "lab" else rgb
+
+
+@pytest.mark.parametrize("dtype", ["uint8", "float16"])
+@pytest.mark.parametrize("space", ["rgb", "lab"])
+def test_round_trip(palettes, tmp_path, dtype, space):
+    path = str(tmp_path / "palettes.bin")
+    assert write_packed(palettes, path, dtype, space) == len(palettes)
+
+    packed = PackedPalettes(path)
+    assert (packed.dtype, packed.space) == (dtype, space)
+    assert len(packed) == len(palettes)
+    assert [name for name, _ in packed.items()] == list(palettes)
+    for name, palette in palettes.items():
+        colors = packed[name]
+        assert colors.shape == (len(palette), 3)
+        np.testing.assert_allclose(colors, expected_colors(palette, space), rtol=0, atol=TOLERANCE[dtype, space])
+
+
+def test_uint8_rgb_stores_rounded_values(tmp_path):
+    path = str(tmp_path / "palettes.bin")
+    write_packed({"a.jpg": [{"r": 0.4, "g": 127.6, "b": 255}]}, path)
+    np.testing.assert_array_equal(PackedPalettes(path)["a.jpg"], [[0, 128, 255]])
+
+
+@pytest.mark.parametrize("dtype", ["uint8", "float16"])
+def test_no_images(tmp_path, dtype):
+    path = str(tmp_path / "palettes.bin")
+    assert write_packed({}, path, dtype) == 0
+    packed = PackedPalettes(path)
+    assert len(packed) == 0
+    assert list(packed.items()) == []
+
+
+def test_sharded_round_trip(palettes, tmp_path):
+    shards = 3
+    paths = write_sharded(palettes, str(tmp_path / "palettes.bin"), shards, "float16", "lab")
+    assert len(paths) == shards
+
+    seen = {}
+    for i, path in enumerate(paths):
+        for name, colors in PackedPalettes(path).items():
+            assert shard_of(name, shards) == i
+            seen[name] = colors
+    assert sorted(seen) == sorted(palettes)
+    for name, palette in palettes.items():
+        np.testing.assert_allclose(seen[name], expected_colors(palette, "lab"), rtol=0, atol=TOLERANCE["float16", "lab"])
+
+
+def test_invalid_arguments_and_files(tmp_path):
+    path = str(tmp_path / "palettes.bin")
+    with pytest.raises(ValueError):
+        write_packed({}, path, dtype="float32")
+    with pytest.raises(ValueError):
+        write_packed({}, path, space="hsv")
+    with open(path, "wb") as f:
+        f.write(b"\0" * 64)
+    with pytest.raises(ValueError):
+        PackedPalettes(path)
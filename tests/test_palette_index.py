@@ -0,0 +1,24 @@
+import pytest
+
+from utils.palette_index import PaletteIndex, hex_to_lab
+
+pytest.importorskip("scipy.spatial")
+
+RED = {"r": 255, "g": 0, "b": 0}
+BLUE = {"r": 0, "g": 0, "b": 255}
+WHITE = {"r": 255, "g": 255, "b": 255}
+
+
+@pytest.mark.parametrize("palettes", [{}, {"a.jpg": [], "b.jpg": []}])
+def test_empty_index_returns_no_results(palettes):
+    index = PaletteIndex(palettes)
+    assert index.names == []
+    assert index.query_color(hex_to_lab("ff0000")) == []
+    assert index.query_palette([hex_to_lab("ff0000"), hex_to_lab("0000ff")]) == []
+
+
+def test_queries_skip_empty_palettes():
+    index = PaletteIndex({"red.jpg": [RED, WHITE], "empty.jpg": [], "blue.jpg": [BLUE, WHITE, BLUE]})
+    assert [name for name, _ in index.query_color(hex_to_lab("0000ff"), k=5)] == ["blue.jpg", "red.jpg"]
+    assert index.query_palette([hex_to_lab("ff0000"), hex_to_lab("ffffff")], k=1)[0][0] == "red.jpg"
+    assert index.query_color(hex_to_lab("0000ff"), k=0) == []
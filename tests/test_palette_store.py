@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from utils.palette_store import PaletteStore
+from utils.parallel import imap_jobs
+from utils.pca_radial import iter_palettes
+
+Image = pytest.importorskip("PIL.Image")
+
+
+@pytest.fixture
+def images_dir(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    images = tmp_path / "images"
+    images.mkdir()
+    for name, size in [("a.png", 16), ("huge.png", 64), ("b.png", 16)]:
+        Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8)).save(str(images / name))
+    # PIL refuses images over twice this many pixels with a DecompressionBombError
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    return images
+
+
+def test_iter_palettes_skips_decompression_bomb(images_dir):
+    names = [name for name, palette in iter_palettes(str(images_dir), num_segments=4, workers=1)]
+    assert names == ["a.png", "b.png"]
+
+
+def test_refresh_skips_decompression_bomb(images_dir, tmp_path):
+    store = PaletteStore(str(tmp_path / "store"), num_segments=4)
+    assert store.refresh(str(images_dir), workers=1) == {"computed": 2, "cached": 0, "evicted": 0}
+    assert [name for name, palette in store.items()] == ["a.png", "b.png"]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_imap_jobs_keeps_job_order(workers):
+    assert list(imap_jobs(abs, [-3, 1, -2, 5], workers)) == [3, 1, 2, 5]
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from utils.palette_stream import TiffBands, iter_strips, open_source, stream_palette
+
+tifffile = pytest.importorskip("tifffile")
+
+
+@pytest.fixture(scope="module")
+def rgb():
+    y, x = np.mgrid[0:100, 0:70]
+    noise = np.random.default_rng(0).integers(0, 40, (100, 70, 3))
+    return (np.stack([x * 3, y * 2, 255 - x - y], axis=-1) + noise).clip(0, 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize("layout", [{"rowsperstrip": 16}, {"tile": (32, 32)}])
+def test_tiff_is_streamed_band_by_band(rgb, tmp_path, layout):
+    path = str(tmp_path / "sky.tif")
+    tifffile.imwrite(path, rgb, compression="zlib", **layout)
+
+    source = open_source(path)
+    assert isinstance(source, TiffBands)
+    bands = list(source.bands())
+    assert [len(band) for band in bands] == ([16] * 6 + [4] if "rowsperstrip" in layout else [32] * 3 + [4])
+    np.testing.assert_array_equal(np.concatenate(bands), rgb)
+
+    strips = list(iter_strips(path, rows=10))
+    assert max(len(strip) for strip in strips) <= 10 * 70
+    np.testing.assert_array_equal(np.concatenate(strips), rgb.reshape(-1, 3))
+    for exact in (False, True):
+        assert stream_palette(path, exact=exact) == stream_palette(rgb, exact=exact)
+
+
+def test_gray_tiff_fills_three_channels(rgb, tmp_path):
+    path = str(tmp_path / "gray.tif")
+    tifffile.imwrite(path, rgb[..., 0], rowsperstrip=8)
+    np.testing.assert_array_equal(np.concatenate(list(open_source(path).bands())),
+                                  np.repeat(rgb[..., :1], 3, axis=-1))
+
+
+def test_16_bit_tiff_is_not_streamed(rgb, tmp_path):
+    path = str(tmp_path / "wide.tif")
+    tifffile.imwrite(path, rgb.astype(np.uint16) * 257, photometric="rgb")
+    assert TiffBands.open(path) is None
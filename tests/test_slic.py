@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import pytest
+
+from utils.color_convert import rgb2lab
+from utils.slic import SLICProcessor, connected_labels
+
+LENNA = os.path.join(os.path.dirname(__file__), os.pardir, "data", "Lenna.png")
+
+
+@pytest.fixture(scope="module")
+def lab():
+    Image = pytest.importorskip("PIL.Image")
+    rgb = np.asarray(Image.open(LENNA).convert("RGB"))
+    # An 86 x 86 crop keeps the per-pixel loop engine around a second
+    return rgb2lab(rgb[200:286, 200:286]).astype(np.float64)
+
+
+@pytest.mark.parametrize("connectivity", [False, True])
+def test_vectorized_engine_matches_loop_engine(lab, connectivity):
+    vectorized = SLICProcessor(lab, 32, 30, vectorized=True)
+    loop = SLICProcessor(lab, 32, 30, vectorized=False)
+    labels, centers = vectorized.run(max_iter=3, tol=0, connectivity=connectivity)
+    loop_labels, loop_centers = loop.run(max_iter=3, tol=0, connectivity=connectivity)
+
+    np.testing.assert_array_equal(labels, loop_labels)
+    np.testing.assert_allclose(centers, loop_centers)
+    assert vectorized.n_iter == loop.n_iter == 3
+
+
+def assert_connected_consecutive(labels):
+    from skimage.measure import label as label_components
+
+    assert labels.min() >= 0
+    assert np.array_equal(np.unique(labels), np.arange(labels.max() + 1))
+    # One 4-connected component per label
+    assert label_components(labels, background=-1, connectivity=1).max() == labels.max() + 1
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_connected_labels_invariants(seed):
+    pytest.importorskip("skimage.measure")
+    rng = np.random.default_rng(seed)
+    # 20 x 20 blocks with stray pixels of other labels, unassigned pixels and a split label
+    labels = np.arange(100)[:, None] // 20 * 10 + np.arange(120)[None, :] // 20
+    stray = rng.random(labels.shape) < 0.05
+    labels[stray] = rng.integers(0, labels.max() + 1, stray.sum())
+    labels[rng.random(labels.shape) < 0.02] = -1
+    labels[40:60, 100:120] = 0
+
+    min_size = 100
+    result = connected_labels(labels, min_size)
+
+    assert result.shape == labels.shape
+    assert_connected_consecutive(result)
+    sizes = np.bincount(result.ravel())
+    # Only the component at the top-left corner may stay small, it has no earlier neighbour
+    assert np.all(np.delete(sizes, result[0, 0]) >= min_size)
+    # Both fragments of label 0 are large enough to stay labels of their own
+    assert result[0, 0] != result[50, 110]
+
+
+def test_connected_labels_after_slic(lab):
+    labels, centers = SLICProcessor(lab, 32, 30).run(max_iter=3, tol=0, connectivity=True)
+    assert_connected_consecutive(labels)
+    assert len(centers) == labels.max() + 1
@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+import pytest
+
+from utils import slic_batch
+
+Image = pytest.importorskip("PIL.Image")
+pytest.importorskip("skimage.measure")
+
+
+def save_image(path, seed):
+    rng = np.random.default_rng(seed)
+    Image.fromarray(rng.integers(0, 256, (30, 40, 3), dtype=np.uint8)).save(str(path))
+
+
+@pytest.fixture
+def segmented(tmp_path, monkeypatch):
+    images = tmp_path / "images"
+    images.mkdir()
+    save_image(images / "a.png", 0)
+    save_image(images / "b.png", 1)
+    calls = []
+    segment_file = slic_batch.segment_file
+
+    def counting_segment_file(path, *args, **kwargs):
+        calls.append(os.path.basename(path))
+        return segment_file(path, *args, **kwargs)
+
+    monkeypatch.setattr(slic_batch, "segment_file", counting_segment_file)
+
+    def run(K=6):
+        del calls[:]
+        index, failures = slic_batch.segment_directory(str(images), str(tmp_path / "out"), K=K, max_iter=2,
+                                                       workers=1, progress=False)
+        assert failures == {}
+        return index, sorted(calls)
+
+    return images, run
+
+
+def test_rerun_skips_unchanged_images(segmented):
+    images, run = segmented
+    index, calls = run()
+    assert calls == ["a.png", "b.png"]
+    stat = os.stat(str(images / "a.png"))
+    assert (index["a.png"]["size"], index["a.png"]["mtime"]) == (stat.st_size, stat.st_mtime_ns)
+
+    assert run() == (index, [])
+    assert run(K=8)[1] == ["a.png", "b.png"]
+
+
+def test_rerun_segments_replaced_file_again(segmented):
+    images, run = segmented
+    run()
+    save_image(images / "b.png", 2)
+    stat = os.stat(str(images / "b.png"))
+    # Same size, only the mtime tells the new file apart
+    os.utime(str(images / "b.png"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    index, calls = run()
+    assert calls == ["b.png"]
+    assert index["b.png"]["mtime"] == stat.st_mtime_ns + 10 ** 9
@@ -0,0 +1,51 @@
+"""Sky palette toolkit: fetching, filtering, segmenting and extracting palettes of sky images.
+
+Submodules import numpy, PIL, scipy and skimage only when they need them, and the names
+below are resolved on first access, so `import utils` and `python -m utils --help` stay
+cheap for short-lived worker processes. See `python -m utils --help` for the command line.
+"""
+import importlib
+
+__version__ = "0.1.0"
+
+# Public name -> submodule defining it, imported on first attribute access
+_EXPORTS = {
+    "rgb2lab": "color_convert",
+    "lab2rgb": "color_convert",
+    "delta_e": "color_convert",
+    "calculate_color_entropy": "color_entropy",
+    "get_rgb_array": "color_histogram",
+    "quantize_colors": "color_histogram",
+    "Custom_KMeans": "custom_kmeans",
+    "MiniBatch_KMeans": "custom_kmeans",
+    "iter_expressiveness": "filter_expressiveness",
+    "DecodedImage": "image_cache",
+    "load_image": "image_cache",
+    "PaletteIndex": "palette_index",
+    "PaletteStore": "palette_store",
+    "stream_palette": "palette_stream",
+    "extract_color_pca_radial": "pca_radial",
+    "iter_palettes": "pca_radial",
+    "write_palettes": "pca_radial",
+    "SLICProcessor": "slic",
+    "segment_directory": "slic_batch",
+    "SuperpixelTable": "superpixels",
+    "superpixel_table": "superpixels",
+    "kmeans_palette": "superpixels",
+}
+
+__all__ = ["__version__"] + sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(importlib.import_module("." + module, __name__), name)
+    # Cached so the next access is a plain module attribute
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
@@ -0,0 +1,38 @@
+import argparse
+import importlib
+import sys
+
+from utils import __version__
+
+# Subcommand -> (module, function taking argv, help). The module is only imported once
+# the command is known, so --help and --version never load numpy or the image libraries.
+COMMANDS = {
+    "fetch": ("data.fetcher", "cli", "download sky images"),
+    "filter": ("utils.filter_expressiveness", "main", "list the images expressive enough to use"),
+    "segment": ("utils.slic_batch", "main", "segment a directory of images with SLIC"),
+    "palette": ("utils.pca_radial", "main", "extract the PCA radial palettes of a directory into data.json"),
+    "stream": ("utils.palette_stream", "main", "extract palettes of very large images or frame sequences"),
+    "serve": ("utils.palette_index", "main", "serve color and palette queries over data.json"),
+    "benchmark": ("utils.benchmark", "main", "time the pipeline stages"),
+    "metrics": ("utils.instrument", "main", "summarize a metrics file written with SKY_METRICS"),
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m utils", description="Sky palette toolkit")
+    parser.add_argument("--version", action="version", version="%(prog)s " + __version__)
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+    for name, (module, function, help) in COMMANDS.items():
+        # Without options of its own, everything after the command is left over for it
+        commands.add_parser(name, help=help, add_help=False)
+    args, command_argv = parser.parse_known_args(argv)
+
+    module, function, help = COMMANDS[args.command]
+    # The subcommand parses its own arguments, under its own name in usage messages
+    sys.argv[0] = "python -m utils " + args.command
+    return getattr(importlib.import_module(module), function)(command_argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
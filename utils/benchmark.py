@@ -0,0 +1,218 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+# Benchmark of the hot paths on synthetic sky gradients and the sample images of data/.
+#   python -m utils.benchmark -o baseline.json
+#   python -m utils.benchmark --compare baseline.json --threshold 0.2
+# Each stage is timed on every input (best of --repeat runs), then run once more
+# under tracemalloc for its peak memory, which is left out of the timings.
+
+SYNTHETIC_SIZES = {"sky-640x480": (480, 640), "sky-1920x1080": (1080, 1920), "sky-4000x3000": (3000, 4000)}
+SAMPLE_PATTERNS = ("data/Lenna.png", "data/sample*.jpg")
+
+
+def sky_gradient(height, width, seed=0):
+    """Synthetic sky photo: a vertical dusk gradient with a sun glow and some sensor noise."""
+    rng = np.random.default_rng(seed)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    x = np.linspace(0, 1, width, dtype=np.float32)[None, :, None]
+    zenith = np.array([20, 40, 110], dtype=np.float32)
+    horizon = np.array([250, 150, 80], dtype=np.float32)
+    sky = zenith + (horizon - zenith) * y ** 1.5
+    glow = np.exp(-((x - 0.7) ** 2 + (y - 0.85) ** 2) / 0.02)
+    sky = sky + glow * np.array([5, 60, 90], dtype=np.float32)
+    sky += rng.normal(0, 2, (height, width, 1)).astype(np.float32)
+    return np.clip(sky, 0, 255).astype(np.uint8)
+
+
+def load_inputs(directory, synthetic=SYNTHETIC_SIZES, patterns=SAMPLE_PATTERNS):
+    """Returns {input name: (path, uint8 rgb array)}; synthetic images are saved to directory
+    as JPEG so the decoding stages read a file like they do in production."""
+    from PIL import Image
+
+    inputs = {}
+    for name, (height, width) in synthetic.items():
+        rgb = sky_gradient(height, width)
+        path = os.path.join(directory, name + ".jpg")
+        Image.fromarray(rgb).save(path, quality=95)
+        inputs[name] = (path, rgb)
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            inputs[os.path.basename(path)] = (path, np.asarray(Image.open(path).convert("RGB")))
+    return inputs
+
+
+def stage_decode(path, rgb):
+    from utils.image_cache import decode_image
+    decode_image(path)
+
+
+def stage_lab(path, rgb):
+    from utils.color_convert import rgb2lab
+    rgb2lab(rgb)
+
+
+def stage_entropy(path, rgb):
+    from utils.color_entropy import calculate_color_entropy
+    calculate_color_entropy(rgb)
+
+
+def stage_filter(path, rgb):
+    # One image of filter_expressiveness: reduced decode and entropy
+    from utils.filter_expressiveness import score_image
+    score_image(path, 512)
+
+
+def stage_quantize(path, rgb):
+    from utils.color_histogram import quantize_colors
+    quantize_colors(rgb, bits=5)
+
+
+def stage_pca_radial(path, rgb):
+    from utils.pca_radial import extract_color_pca_radial
+    extract_color_pca_radial(rgb)
+
+
+def stage_pca_radial_hist(path, rgb):
+    from utils.color_histogram import quantize_colors
+    from utils.pca_radial import extract_color_pca_radial
+    colors, counts = quantize_colors(rgb, bits=5)
+    extract_color_pca_radial(colors, counts)
+
+
+def stage_kmeans(path, rgb):
+    from utils.custom_kmeans import Custom_KMeans
+    Custom_KMeans(5, max_iters=20, random_state=0, init="k-means++").fit(rgb.reshape(-1, 3).astype(np.float64))
+
+
+def stage_slic(path, rgb):
+    from utils.color_convert import rgb2lab
+    from utils.slic import SLICProcessor
+    SLICProcessor(rgb2lab(rgb), K=200, M=30, pyramid_levels="auto").run(max_iter=5)
+
+
+STAGES = {
+    "decode": stage_decode,
+    "lab": stage_lab,
+    "entropy": stage_entropy,
+    "filter": stage_filter,
+    "quantize": stage_quantize,
+    "pca_radial": stage_pca_radial,
+    "pca_radial_hist": stage_pca_radial_hist,
+    "kmeans": stage_kmeans,
+    "slic": stage_slic,
+}
+
+
+def measure(stage, path, rgb, repeat=3):
+    """Returns the best wall time of repeat runs and the peak traced memory of one more run."""
+    seconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        stage(path, rgb)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        stage(path, rgb)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return seconds, peak
+
+
+def run_benchmarks(inputs, stages=None, repeat=3, log=print):
+    """Runs the stages on every input.
+    Returns:
+        Dict "<stage>/<input>" -> {"pixels", "seconds", "pixels_per_second", "peak_bytes"}
+    """
+    results = {}
+    for stage_name in stages or STAGES:
+        for input_name, (path, rgb) in inputs.items():
+            pixels = rgb.shape[0] * rgb.shape[1]
+            seconds, peak = measure(STAGES[stage_name], path, rgb, repeat)
+            key = "%s/%s" % (stage_name, input_name)
+            results[key] = {
+                "pixels": pixels,
+                "seconds": seconds,
+                "pixels_per_second": pixels / seconds,
+                "peak_bytes": peak,
+            }
+            log("%-40s %9.4f s %8.2f Mpx/s %9.1f MB" % (key, seconds, pixels / seconds / 1e6, peak / 1e6))
+    return results
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def compare(results, baseline, threshold=0.2, log=print):
+    """Compares results with a baseline.
+    Args:
+        threshold Allowed relative slowdown (or memory growth), 0.2 for 20%
+    Returns:
+        List of the regressed "<stage>/<input>" keys
+    """
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        before = baseline[key]
+        time_ratio = result["seconds"] / before["seconds"]
+        memory_ratio = result["peak_bytes"] / max(before["peak_bytes"], 1)
+        regressed = time_ratio > 1 + threshold or memory_ratio > 1 + threshold
+        if regressed:
+            regressions.append(key)
+        log("%-40s time x%.2f  memory x%.2f%s" % (key, time_ratio, memory_ratio, "  REGRESSION" if regressed else ""))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the palette, SLIC, k-means and entropy stages")
+    parser.add_argument("-o", "--output", default=None, help="write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="baseline JSON file to compare the results with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative slowdown or memory growth that fails the comparison")
+    parser.add_argument("--stages", nargs="+", choices=sorted(STAGES), default=None, help="stages to run")
+    parser.add_argument("--sizes", nargs="+", choices=sorted(SYNTHETIC_SIZES), default=None,
+                        help="synthetic images to use (default: all)")
+    parser.add_argument("--no-samples", action="store_true", help="skip the sample images of data/")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage, the best one is kept")
+    args = parser.parse_args(argv)
+
+    synthetic = {name: SYNTHETIC_SIZES[name] for name in (args.sizes or SYNTHETIC_SIZES)}
+    with tempfile.TemporaryDirectory() as directory:
+        inputs = load_inputs(directory, synthetic, () if args.no_samples else SAMPLE_PATTERNS)
+        results = run_benchmarks(inputs, args.stages, args.repeat)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["results"], args.threshold)
+        if regressions:
+            print("%d regression(s) past %d%%" % (len(regressions), round(args.threshold * 100)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import argparse
+import time
+
+import numpy as np
+
+from utils.instrument import timed
+
+# sRGB <-> CIELAB with the same constants as skimage.color (D65 white, 2 degree observer),
+# computed in float32 and in chunks so the temporaries stay small on full-resolution photos
+XYZ_FROM_RGB = np.array([[0.412453, 0.357580, 0.180423],
+                         [0.212671, 0.715160, 0.072169],
+                         [0.019334, 0.119193, 0.950227]])
+RGB_FROM_XYZ = np.linalg.inv(XYZ_FROM_RGB)
+WHITE = np.array([0.95047, 1.0, 1.08883])
+# Row-vector matrices with the white point folded in: xyz / white = rgb @ LAB_FROM_LINEAR
+LAB_FROM_LINEAR = (XYZ_FROM_RGB / WHITE[:, None]).T.astype(np.float32)
+LINEAR_FROM_LAB = (RGB_FROM_XYZ * WHITE[None, :]).T.astype(np.float32)
+CHUNK_SIZE = 1 << 18
+
+
+def srgb_to_linear(rgb):
+    """Removes the sRGB gamma of 0-1 float values."""
+    rgb = np.asarray(rgb, dtype=np.float32)
+    return np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92).astype(np.float32)
+
+
+def linear_to_srgb(linear):
+    linear = np.asarray(linear, dtype=np.float32)
+    return np.where(linear > 0.0031308,
+                    1.055 * np.power(np.maximum(linear, 0.0031308), 1 / 2.4) - 0.055,
+                    linear * 12.92).astype(np.float32)
+
+
+# An 8-bit channel only has 256 values, so its linearization is a table lookup.
+# A trilinear 3-D table of the whole conversion was tried too: its 8 gathers per pixel
+# cost more than the direct float32 computation below, so there is none.
+LINEAR_TABLE = srgb_to_linear(np.arange(256) / 255)
+
+
+def _lab_from_linear(linear):
+    xyz = linear @ LAB_FROM_LINEAR
+    f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + np.float32(16 / 116))
+    lab = np.empty_like(f)
+    lab[:, 0] = 116 * f[:, 1] - 16
+    lab[:, 1] = 500 * (f[:, 0] - f[:, 1])
+    lab[:, 2] = 200 * (f[:, 1] - f[:, 2])
+    return lab
+
+
+@timed("lab")
+def rgb2lab(rgb, chunk_size=CHUNK_SIZE):
+    """Converts sRGB to CIELAB.
+    Args:
+        rgb (..., 3) array; extra channels are ignored. As in skimage (img_as_float),
+            floats are 0-1 and integers are scaled by the maximum of their dtype,
+            e.g. 0-255 for uint8 and 0-65535 for 16-bit PNGs
+        chunk_size Number of pixels converted at once
+    Returns:
+        float32 array of the same shape, L in [0, 100], a and b in about [-128, 127]
+    """
+    rgb = np.asarray(rgb)[..., :3]
+    flat = rgb.reshape(-1, 3)
+    lab = np.empty(flat.shape, dtype=np.float32)
+    for start in range(0, len(flat), chunk_size):
+        chunk = flat[start:start + chunk_size]
+        if chunk.dtype == np.uint8:
+            linear = LINEAR_TABLE[chunk]
+        elif chunk.dtype.kind in "ui":
+            linear = srgb_to_linear(chunk / np.float64(np.iinfo(chunk.dtype).max))
+        else:
+            linear = srgb_to_linear(chunk)
+        lab[start:start + chunk_size] = _lab_from_linear(linear)
+    return lab.reshape(rgb.shape)
+
+
+def lab2rgb(lab, chunk_size=CHUNK_SIZE):
+    """Converts CIELAB to sRGB.
+    Returns:
+        float32 array of the same shape with 0-1 values, out of gamut colors are clipped
+    """
+    lab = np.asarray(lab)
+    flat = lab.reshape(-1, 3)
+    rgb = np.empty(flat.shape, dtype=np.float32)
+    for start in range(0, len(flat), chunk_size):
+        chunk = flat[start:start + chunk_size].astype(np.float32)
+        fy = (chunk[:, 0] + 16) / 116
+        f = np.column_stack((fy + chunk[:, 1] / 500, fy, np.maximum(fy - chunk[:, 2] / 200, 0)))
+        xyz = np.where(f > 0.2068966, f ** 3, (f - np.float32(16 / 116)) / 7.787)
+        rgb[start:start + chunk_size] = np.clip(linear_to_srgb(xyz @ LINEAR_FROM_LAB), 0, 1)
+    return rgb.reshape(lab.shape)
+
+
+def delta_e(lab1, lab2):
+    """CIE76 color difference."""
+    return np.linalg.norm(np.asarray(lab1, dtype=np.float64) - np.asarray(lab2, dtype=np.float64), axis=-1)
+
+
+def _timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main(argv=None):
+    """Checks the accuracy of the conversions against skimage and times them on an image."""
+    from PIL import Image
+    from skimage import color
+
+    parser = argparse.ArgumentParser(description="Compare the color conversions with skimage")
+    parser.add_argument("image", nargs="?", default="data/Lenna.png")
+    args = parser.parse_args(argv)
+
+    rgb = np.asarray(Image.open(args.image).convert("RGB"))
+    print("%s: %d x %d" % (args.image, rgb.shape[1], rgb.shape[0]))
+
+    reference, reference_time = _timed(color.rgb2lab, rgb)
+    lab, lab_time = _timed(rgb2lab, rgb)
+    back_reference, back_reference_time = _timed(color.lab2rgb, reference)
+    back, back_time = _timed(lab2rgb, reference)
+
+    print("%-22s %10s %10s %12s" % ("", "seconds", "speedup", "max error"))
+    print("%-22s %10.3f %10s %12s" % ("skimage rgb2lab", reference_time, "1.0x", "-"))
+    print("%-22s %10.3f %9.1fx %9.4f dE" % ("rgb2lab", lab_time, reference_time / lab_time,
+                                            delta_e(lab, reference).max()))
+    print("%-22s %10.3f %10s %12s" % ("skimage lab2rgb", back_reference_time, "1.0x", "-"))
+    print("%-22s %10.3f %9.1fx %9.4f /255" % ("lab2rgb", back_time, back_reference_time / back_time,
+                                              np.abs(back - back_reference).max() * 255))
+
+
+if __name__ == "__main__":
+    main()
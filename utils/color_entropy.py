@@ -1,25 +1,88 @@
-from PIL import Image
-import math
-import os
+import numpy as np
 
+from utils.color_convert import rgb2lab
 
-def calculate_color_entropy(image):
+
+def encode_lab(lab):
+    """Encodes float CIELAB as (n, 3) uint8: L scaled from [0, 100] to [0, 255], a and b offset by 128.
+    This is not PIL's "LAB" mode, which stores a and b as two's complement bytes and computes L
+    differently; every input of to_lab_bytes goes through utils.color_convert and this encoding,
+    so an image scores the same however it was decoded."""
+    lab = np.asarray(lab).reshape(-1, 3)
+    encoded = np.empty(lab.shape, dtype=np.float32)
+    encoded[:, 0] = lab[:, 0] * (255 / 100)
+    encoded[:, 1:] = lab[:, 1:] + 128
+    return np.clip(np.rint(encoded), 0, 255).astype(np.uint8)
+
+
+def to_lab_bytes(image, space="rgb"):
+    """Returns the LAB channels of an image as a (n, 3) uint8 array (see encode_lab).
+    Args:
+        image Path, PIL image, array or utils.image_cache.DecodedImage
+              Arrays are (h, w, 3) / (n, 3) RGB when space is "rgb": integers in 0-255,
+              or floats in 0-1 (or 0-255 when any value is above 1, as get_rgb_array),
+              or float CIELAB (L in [0, 100], a and b in [-128, 127]) when space is "lab",
+              e.g. the LAB array of a decode done in another stage
+        space Color space of an array input
+    """
+    if hasattr(image, "lab"):
+        image, space = image.lab, "lab"
     if isinstance(image, str):
+        from PIL import Image
         image = Image.open(image)
-    # Convert image to RGB mode
-    image_rgb = image.convert("RGB")
 
-    # Convert image to LAB color space
-    lab_image = image_rgb.convert("LAB")
+    if hasattr(image, "convert"):
+        # PIL image
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image = np.asarray(image)
+
+    image = np.asarray(image)
+    if space == "lab":
+        return encode_lab(image)
+
+    rgb = image[..., :3].reshape(-1, 3)
+    if rgb.dtype.kind == "f":
+        if rgb.size and rgb.max() > 1.0:
+            rgb = rgb / 255
+    elif rgb.dtype != np.uint8:
+        if rgb.size and (rgb.min() < 0 or rgb.max() > 255):
+            raise ValueError("integer RGB arrays must hold 0-255 values, got %s to %s" % (rgb.min(), rgb.max()))
+        rgb = rgb.astype(np.uint8)
+    return encode_lab(rgb2lab(rgb))
+
+
+def histogram_entropy(hist):
+    # Entropy in bits of a histogram of counts
+    hist = hist[hist > 0]
+    p = hist / hist.sum()
+    return float(-np.sum(p * np.log2(p)))
 
-    # Calculate histogram of color values
-    # This calculates the histogram for each channel (L, A, B) separately
-    hist = lab_image.histogram()
 
-    # Normalize histogram
-    hist = [float(h) / sum(hist) for h in hist]
+def calculate_color_entropy(image, joint=False, bits=4, space="rgb"):
+    """Calculates the color entropy of an image in LAB space.
+    Args:
+        image Path, PIL image or array (see to_lab_bytes)
+        joint False computes the entropy of the three per-channel histograms
+              (768 bins, as PIL's histogram()), True the entropy of the joint
+              3-D LAB histogram with bits bits per channel
+        bits Bits per channel of the joint histogram
+        space Color space of an array input, "rgb" or "lab"
+    Returns:
+        The entropy in bits
+    """
+    lab = to_lab_bytes(image, space)
 
-    # Calculate entropy
-    entropy = -sum(p * math.log(p, 2) for p in hist if p != 0)
+    if joint:
+        shift = 8 - bits
+        index = ((lab[:, 0].astype(np.int64) >> shift) << (2 * bits)) | \
+                ((lab[:, 1].astype(np.int64) >> shift) << bits) | \
+                (lab[:, 2].astype(np.int64) >> shift)
+        hist = np.bincount(index, minlength=1 << (3 * bits))
+    else:
+        # Calculate histogram of color values
+        # This calculates the histogram for each channel (L, A, B) separately
+        # with the channels laid out one after the other, like PIL's histogram()
+        hist = np.bincount((lab + np.array([0, 256, 512], dtype=np.int64)).ravel(), minlength=768)
 
-    return entropy
+    return histogram_entropy(hist)
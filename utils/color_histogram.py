@@ -0,0 +1,77 @@
+import numpy as np
+
+from utils.instrument import timer
+
+# Value ranges used to bin each color space, per channel
+CHANNEL_RANGES = {
+    "rgb": ((0.0, 256.0), (0.0, 256.0), (0.0, 256.0)),
+    # CIELAB as returned by skimage.color.rgb2lab
+    "lab": ((0.0, 100.0), (-128.0, 128.0), (-128.0, 128.0)),
+}
+
+
+def get_rgb_array(image):
+    """Returns the pixels of an image as an (n, 3) array of 0-255 RGB values.
+    Args:
+        image Path, PIL image, (h, w, 3) / (n, 3) array or utils.image_cache.DecodedImage
+    Returns:
+        (n, 3) array
+    """
+    if hasattr(image, "rgb"):
+        image = image.rgb
+    with timer("decode"):
+        if isinstance(image, str):
+            from PIL import Image
+            image = Image.open(image)
+        if hasattr(image, "convert"):
+            image = image.convert("RGB")
+    pixel_values = np.asarray(image)[..., :3].reshape(-1, 3)
+
+    # Convert normalized values to 0-255 range if necessary
+    if pixel_values.dtype.kind == "f" and pixel_values.size and pixel_values.max() <= 1.0:
+        pixel_values = pixel_values * 255
+    return pixel_values
+
+
+def bin_index(pixels, bits, space="rgb"):
+    """Returns the histogram bin of every (n, 3) pixel, with bits bits per channel."""
+    n_bins = 1 << bits
+    index = np.zeros(len(pixels), dtype=np.int64)
+    for channel, (low, high) in enumerate(CHANNEL_RANGES[space]):
+        channel_bin = ((pixels[:, channel] - low) * (n_bins / (high - low))).astype(np.int64)
+        np.clip(channel_bin, 0, n_bins - 1, out=channel_bin)
+        index = (index << bits) | channel_bin
+    return index
+
+
+def quantize_colors(image, bits=5, space="rgb"):
+    """Bins an image into a color histogram and returns the non-empty bins.
+    Sky photos are smooth gradients, so millions of pixels collapse into a few
+    thousand bins that can be clustered with their counts as weights.
+    Args:
+        image Path, PIL image or array accepted by get_rgb_array
+        bits Bits kept per channel, the histogram has 2 ** (3 * bits) bins
+        space "rgb" or "lab", the color space of the bins and of the returned colors
+    Returns:
+        colors (m, 3) mean color of the pixels that fell into each non-empty bin
+        counts (m,) number of pixels in each bin
+    """
+    pixels = get_rgb_array(image)
+    if space == "lab":
+        from utils.color_convert import rgb2lab
+        # 8-bit pixels are converted through the linearization table
+        pixels = rgb2lab(pixels if pixels.dtype == np.uint8 else pixels / 255).astype(np.float64)
+    elif space == "rgb":
+        pixels = pixels.astype(np.float64)
+    else:
+        raise ValueError("Unknown color space '%s'" % (space,))
+
+    n_bins = 1 << bits
+    index = bin_index(pixels, bits, space)
+    counts = np.bincount(index, minlength=n_bins ** 3)
+    occupied = np.flatnonzero(counts)
+    # The mean of the pixels in a bin is a better representative than the bin center
+    colors = np.column_stack([np.bincount(index, weights=pixels[:, channel], minlength=n_bins ** 3)[occupied]
+                              for channel in range(3)])
+    counts = counts[occupied]
+    return colors / counts[:, None], counts
@@ -1,65 +1,286 @@
 import numpy as np
 import random
 
+from utils.instrument import count, timed
+
 
 class Cluster:
     def __init__(self, centroid):
         self.centroid = centroid
-        self.points = []
+        self._points = []
+        self._owner = None
+        self._index = None
+
+    @property
+    def points(self):
+        # Clusters created by a fitted model look their points up lazily in the
+        # data the caller passed to fit, so no copy of it is kept around
+        if self._owner is not None:
+            return self._owner.cluster_points(self._index)
+        return self._points
+
+    @points.setter
+    def points(self, points):
+        self._owner = None
+        self._points = points
 
     def add_point(self, point):
-        self.points.append(point)
+        self._points.append(point)
 
     def clear_points(self):
         self.points = []
 
 
 class Custom_KMeans:
-    def __init__(self, n_clusters, max_iters=100, random_state=None):
+    def __init__(self, n_clusters, max_iters=100, random_state=None, tol=1e-4,
+                 init="random", chunk_size=65536):
         self.n_clusters = n_clusters
         self.max_iters = max_iters
         self.random_state = random_state
+        # We stop once the total squared centroid movement is below
+        # tol times the mean per-dimension variance of the data (as in sklearn)
+        self.tol = tol
+        # init is "random" (sample n_clusters points) or "k-means++"
+        self.init = init
+        # chunk_size bounds the (chunk_size, n_clusters) distance matrix and the float64
+        # copies: data is used in its own dtype (e.g. uint8 pixels) and converted chunk by chunk
+        self.chunk_size = chunk_size
 
-    def fit(self, data):
-        self.clusters = self.initialize_clusters(data)
+    @timed("kmeans.fit")
+    def fit(self, data, sample_weight=None):
+        # sample_weight lets data be a table of unique colors with their
+        # pixel counts (see utils.color_histogram.quantize_colors).
+        # A utils.superpixels.SuperpixelTable is clustered on its LAB means weighted by size
+        if hasattr(data, "sizes"):
+            data, sample_weight = data.lab, data.sizes
+        data = np.asarray(data)
+        if sample_weight is not None:
+            sample_weight = np.asarray(sample_weight, dtype=np.float64)
+        centroids = self.initialize_centroids(data, sample_weight)
+        tol = self.tol * self.mean_variance(data, sample_weight)
 
+        self.n_iter_ = 0
         for _ in range(self.max_iters):
-            for cluster in self.clusters:
-                cluster.clear_points()
+            labels = self.assign_labels(data, centroids)
+            new_centroids = self.calculate_new_centroids(data, labels, centroids, sample_weight)
+            self.n_iter_ += 1
 
-            for point in data:
-                closest_cluster = self.assign_cluster(point)
-                closest_cluster.add_point(point)
+            shift = np.sum((new_centroids - centroids) ** 2)
+            centroids = new_centroids
+            if shift <= tol:
+                break
 
-            new_centroids = self.calculate_new_centroids()
+        count("kmeans.iterations", self.n_iter_)
+        self._set_result(data, centroids)
+        return self
 
-            if self.are_centroids_equal(self.clusters, new_centroids):
-                break
+    def predict(self, data):
+        return self.assign_labels(np.asarray(data), self.cluster_centers_)
 
-            self.update_clusters_centroids(new_centroids)
+    @staticmethod
+    def mean_variance(data, sample_weight=None):
+        # One dimension at a time, so the temporaries are (n,) and not (n, d)
+        return np.mean([np.average((data[:, d] - np.average(data[:, d], weights=sample_weight)) ** 2,
+                                   weights=sample_weight)
+                        for d in range(data.shape[1])])
 
-    def initialize_clusters(self, data):
+    def initialize_centroids(self, data, sample_weight=None):
+        if self.init == "k-means++":
+            return self.kmeans_plus_plus(data, sample_weight)
+        if sample_weight is not None:
+            # Weighted rows are drawn in proportion to how many pixels they stand for.
+            # With fewer weighted rows than clusters some are drawn twice, the duplicate
+            # centroids then end up as empty clusters
+            rng = np.random.default_rng(self.random_state)
+            replace = np.count_nonzero(sample_weight) < self.n_clusters
+            random_indices = rng.choice(len(data), self.n_clusters, replace=replace,
+                                        p=sample_weight / sample_weight.sum())
+            return data[random_indices].astype(np.float64)
         if self.random_state is not None:
             random.seed(self.random_state)
         random_indices = random.sample(range(len(data)), self.n_clusters)
-        initial_centroids = [data[idx] for idx in random_indices]
-        clusters = [Cluster(centroid) for centroid in initial_centroids]
-        return clusters
+        return data[random_indices].astype(np.float64)
 
-    def assign_cluster(self, point):
-        distances = [np.linalg.norm(cluster.centroid - point)
-                     for cluster in self.clusters]
-        closest_cluster_idx = np.argmin(distances)
-        return self.clusters[closest_cluster_idx]
-
-    def calculate_new_centroids(self):
-        new_centroids = [np.mean(cluster.points, axis=0)
-                         for cluster in self.clusters]
+    def kmeans_plus_plus(self, data, sample_weight=None):
+        # Each new centroid is drawn with probability proportional to the
+        # (weighted) squared distance to the closest centroid picked so far
+        rng = np.random.default_rng(self.random_state)
+        centroids = np.empty((self.n_clusters, data.shape[1]))
+        if sample_weight is None:
+            centroids[0] = data[rng.integers(len(data))]
+        else:
+            centroids[0] = data[self.sample_index(rng, sample_weight)]
+        closest = np.full(len(data), np.inf)
+        self.update_closest(data, centroids[0], closest)
+        for k in range(1, self.n_clusters):
+            centroids[k] = data[self.sample_index(rng, closest, sample_weight)]
+            self.update_closest(data, centroids[k], closest)
+        return centroids
+
+    def sample_index(self, rng, values, weights=None):
+        # Draws i with probability proportional to values[i] * weights[i]: first a chunk
+        # in proportion to its total, then a row inside it, so no (n,) temporary is made
+        totals = np.array([
+            np.sum(values[start:start + self.chunk_size]) if weights is None
+            else np.dot(values[start:start + self.chunk_size], weights[start:start + self.chunk_size])
+            for start in range(0, len(values), self.chunk_size)])
+        total = totals.sum()
+        if not total > 0:
+            return int(rng.integers(len(values)))
+        chunk = min(int(np.searchsorted(np.cumsum(totals), rng.random() * total, side="right")), len(totals) - 1)
+        start = chunk * self.chunk_size
+        cumulative = values[start:start + self.chunk_size].astype(np.float64)
+        if weights is not None:
+            cumulative *= weights[start:start + self.chunk_size]
+        np.cumsum(cumulative, out=cumulative)
+        row = int(np.searchsorted(cumulative, rng.random() * cumulative[-1], side="right"))
+        return start + min(row, len(cumulative) - 1)
+
+    def update_closest(self, data, centroid, closest):
+        # closest = min(closest, |x - centroid|^2), chunk by chunk like assign_labels
+        for start in range(0, len(data), self.chunk_size):
+            diff = data[start:start + self.chunk_size] - centroid
+            out = closest[start:start + self.chunk_size]
+            np.minimum(out, np.einsum("ij,ij->i", diff, diff), out=out)
+
+    def assign_labels(self, data, centroids):
+        # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, computed chunk by chunk
+        # |x|^2 is the same for every centroid, so it does not change the argmin.
+        # Distances are laid out (n_clusters, chunk) and the running minimum is taken
+        # one centroid at a time, which is much faster than an argmin along short rows
+        labels = np.empty(len(data), dtype=np.intp)
+        scaled = -2 * np.asarray(centroids, dtype=np.float64)
+        centroid_norms = np.sum(centroids ** 2, axis=1)[:, None]
+        for start in range(0, len(data), self.chunk_size):
+            chunk = data[start:start + self.chunk_size].astype(np.float64)
+            distances = scaled @ chunk.T
+            distances += centroid_norms
+            best = distances[0].copy()
+            chunk_labels = np.zeros(len(chunk), dtype=np.intp)
+            for k in range(1, len(distances)):
+                closer = distances[k] < best
+                chunk_labels[closer] = k
+                np.minimum(best, distances[k], out=best)
+            labels[start:start + self.chunk_size] = chunk_labels
+        return labels
+
+    def label_sums(self, data, labels, sample_weight=None):
+        # One bincount per dimension is much faster than np.add.at on millions of rows
+        counts = np.zeros(self.n_clusters)
+        sums = np.zeros((self.n_clusters, data.shape[1]))
+        for start in range(0, len(data), self.chunk_size):
+            chunk = data[start:start + self.chunk_size].astype(np.float64)
+            chunk_labels = labels[start:start + self.chunk_size]
+            weights = None if sample_weight is None else sample_weight[start:start + self.chunk_size]
+            counts += np.bincount(chunk_labels, weights=weights, minlength=self.n_clusters)
+            if weights is not None:
+                chunk *= weights[:, None]
+            for d in range(data.shape[1]):
+                sums[:, d] += np.bincount(chunk_labels, weights=chunk[:, d], minlength=self.n_clusters)
+        return counts, sums
+
+    def calculate_new_centroids(self, data, labels, centroids, sample_weight=None):
+        counts, sums = self.label_sums(data, labels, sample_weight)
+        new_centroids = centroids.copy()
+        # An empty cluster keeps its previous centroid
+        filled = counts > 0
+        new_centroids[filled] = sums[filled] / counts[filled, None]
         return new_centroids
 
+    def cluster_points(self, index):
+        return np.asarray(self._data[self.labels_ == index], dtype=np.float64)
+
+    # The per-point interface of the original implementation, on top of the fitted model
+
+    def initialize_clusters(self, data):
+        return [Cluster(centroid) for centroid in self.initialize_centroids(np.asarray(data))]
+
+    def assign_cluster(self, point):
+        centroids = np.array([cluster.centroid for cluster in self.clusters], dtype=np.float64)
+        return self.clusters[int(self.assign_labels(np.asarray(point).reshape(1, -1), centroids)[0])]
+
     def are_centroids_equal(self, clusters, new_centroids):
-        return all(np.array_equal(cluster.centroid, new_centroid) for cluster, new_centroid in zip(clusters, new_centroids))
+        return all(np.array_equal(cluster.centroid, new_centroid)
+                   for cluster, new_centroid in zip(clusters, new_centroids))
 
     def update_clusters_centroids(self, new_centroids):
         for cluster, new_centroid in zip(self.clusters, new_centroids):
             cluster.centroid = new_centroid
+
+    def _set_result(self, data, centroids):
+        # data is the caller's array as passed (e.g. uint8 pixels), not a converted copy;
+        # cluster_points converts only the rows it selects
+        self._data = data
+        self.cluster_centers_ = centroids
+        self.labels_ = self.assign_labels(data, centroids)
+        self.clusters = []
+        for k, centroid in enumerate(centroids):
+            cluster = Cluster(centroid)
+            cluster._owner = self
+            cluster._index = k
+            self.clusters.append(cluster)
+
+
+class MiniBatch_KMeans(Custom_KMeans):
+    def __init__(self, n_clusters, batch_size=4096, max_iters=100, random_state=None, tol=1e-4,
+                 init="k-means++", chunk_size=65536):
+        super().__init__(n_clusters, max_iters=max_iters, random_state=random_state, tol=tol,
+                         init=init, chunk_size=chunk_size)
+        self.batch_size = batch_size
+        self.cluster_centers_ = None
+        # counts is how many points each centroid has absorbed so far,
+        # which sets its per-cluster learning rate
+        self.counts_ = None
+        self.n_iter_ = 0
+
+    @timed("kmeans.fit")
+    def fit(self, data, sample_weight=None):
+        if hasattr(data, "sizes"):
+            data, sample_weight = data.lab, data.sizes
+        data = np.asarray(data)
+        probabilities = None
+        if sample_weight is not None:
+            sample_weight = np.asarray(sample_weight, dtype=np.float64)
+            probabilities = sample_weight / sample_weight.sum()
+        rng = np.random.default_rng(self.random_state)
+        tol = self.tol * self.mean_variance(data, sample_weight)
+        self.cluster_centers_ = None
+        self.n_iter_ = 0
+        for _ in range(self.max_iters):
+            # Sampling rows in proportion to their weight makes every batch unweighted
+            batch = data[rng.choice(len(data), size=min(self.batch_size, len(data)), p=probabilities)]
+            previous = None if self.cluster_centers_ is None else self.cluster_centers_.copy()
+            self.partial_fit(batch)
+            if previous is not None and np.sum((self.cluster_centers_ - previous) ** 2) <= tol:
+                break
+
+        count("kmeans.iterations", self.n_iter_)
+        self._set_result(data, self.cluster_centers_)
+        return self
+
+    def partial_fit(self, batch, sample_weight=None):
+        """Updates the centroids with one batch of points.
+        Args:
+            batch (n, d) array, e.g. the pixels of one image strip
+            sample_weight Optional (n,) weights of the batch rows
+        Returns:
+            self
+        """
+        batch = np.asarray(batch, dtype=np.float64)
+        if sample_weight is not None:
+            sample_weight = np.asarray(sample_weight, dtype=np.float64)
+        if self.cluster_centers_ is None:
+            self.cluster_centers_ = self.initialize_centroids(batch, sample_weight)
+            self.counts_ = np.zeros(self.n_clusters)
+
+        labels = self.assign_labels(batch, self.cluster_centers_)
+        batch_counts, sums = self.label_sums(batch, labels, sample_weight)
+
+        # Running mean: every centroid is the average of all points it has absorbed
+        filled = batch_counts > 0
+        totals = self.counts_ + batch_counts
+        self.cluster_centers_[filled] = (self.cluster_centers_[filled] * self.counts_[filled, None] +
+                                         sums[filled]) / totals[filled, None]
+        self.counts_ = totals
+        self.n_iter_ += 1
+        return self
@@ -1,28 +1,119 @@
 # Path to the directory containing images
+import argparse
 import os
-from tkinter import Image
 from utils.color_entropy import calculate_color_entropy
+from utils.instrument import image_context, record_error, timed
+from utils.parallel import imap_jobs
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
 
 # Djust this threshold based on your observation
 
 
-def filter_expressiveness(images_dir, threshold=3.5):
+@timed("decode")
+def open_reduced(image_path, max_size=None):
+    """Opens an image as RGB, decoding it at reduced resolution when possible.
+    This is the one reduction rule of the package, utils.image_cache decodes through it too.
+    Args:
+        image_path The path of the image.
+        max_size Longest side wanted, None decodes at full resolution.
+    Returns:
+        An RGB PIL image with its pixels loaded.
+    """
+    from PIL import Image
+    image = Image.open(image_path)
+    if max_size is not None:
+        # JPEG can decode directly at 1/2, 1/4 or 1/8 scale, reduce() averages pixel blocks the rest of the way
+        image.draft("RGB", (max_size, max_size))
+    if image.mode != "RGB":
+        # Also before reduce(), which does not take palette or 1-bit images
+        image = image.convert("RGB")
+    if max_size is not None:
+        factor = -(-max(image.size) // max_size)
+        if factor > 1:
+            image = image.reduce(factor)
+    image.load()
+    return image
+
+
+def score_image(image_path, max_size=None, cache_dir=None):
+    """Scores one image.
+    Args:
+        cache_dir When set, the image is decoded through utils.image_cache with
+                  this disk directory, so later runs and stages decoding at the same
+                  max_size reuse the decode. The score is the same either way.
+    Returns:
+        The entropy of the image, or None if it could not be read.
+    """
+    from PIL import Image
+    try:
+        if cache_dir is not None:
+            from utils.image_cache import load_image
+            return calculate_color_entropy(load_image(image_path, max_size, cache_dir))
+        return calculate_color_entropy(open_reduced(image_path, max_size))
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as exc:
+        # Unreadable, truncated or oversized files are skipped instead of aborting the batch
+        record_error(exc)
+        return None
+
+
+def _score_job(job):
+    filename, image_path, max_size, cache_dir = job
+    with image_context(filename):
+        return filename, score_image(image_path, max_size, cache_dir)
+
+
+def iter_expressiveness(images_dir, workers=None, chunksize=16, max_size=512, ordered=False, cache_dir=None):
+    """Scores every image of a directory on a process pool.
+    Args:
+        images_dir The directory containing the images.
+        workers Number of worker processes, defaults to the number of CPUs.
+                1 scores in the current process.
+        chunksize Number of images sent to a worker at once.
+        max_size Longest side the images are decoded at, None for full resolution.
+        ordered Yield results in directory order instead of as soon as they are ready.
+        cache_dir Decode cache directory, see score_image.
+    Returns:
+        An iterator of (filename, entropy) tuples. Unreadable images are skipped.
+    """
+    jobs = [(filename, os.path.join(images_dir, filename), max_size, cache_dir)
+            for filename in sorted(os.listdir(images_dir))
+            if filename.lower().endswith(IMAGE_EXTENSIONS)]
+
+    for filename, entropy in imap_jobs(_score_job, jobs, workers, chunksize, ordered):
+        if entropy is not None:
+            yield filename, entropy
+
+
+def filter_expressiveness(images_dir, threshold=3.5, workers=None, chunksize=16, max_size=512, cache_dir=None):
     """Filters images based on their expressiveness.
     Args:
         images_dir The directory containing the images.
         threshold The threshold for the expressiveness.
+        workers, chunksize, max_size, cache_dir See iter_expressiveness.
     Returns:
         A list of filenames of images that have an expressiveness above the threshold.
     """
-    filtered_images = []
+    return [filename
+            for filename, entropy in iter_expressiveness(images_dir, workers, chunksize, max_size,
+                                                                  ordered=True, cache_dir=cache_dir)
+            if entropy >= threshold]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List the images of a directory expressive enough to extract palettes from")
+    parser.add_argument("images_dir", help="directory containing the images")
+    parser.add_argument("--threshold", type=float, default=3.5, help="minimum color entropy in bits")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all CPUs)")
+    parser.add_argument("--max-size", type=int, default=512, help="decode at most this many pixels per side")
+    parser.add_argument("--decode-cache", default=None,
+                        help="directory of decoded images shared with the other stages")
+    args = parser.parse_args(argv)
 
-    for filename in os.listdir(images_dir):
-        if filename.endswith(".jpg") or filename.endswith(".png"):
-            image_path = os.path.join(images_dir, filename)
-            image = Image.open(image_path)
-            entropy = calculate_color_entropy(image)
+    for filename in filter_expressiveness(args.images_dir, args.threshold, args.workers,
+                                          max_size=args.max_size, cache_dir=args.decode_cache):
+        print(filename)
 
-            if entropy >= threshold:
-                filtered_images.append(filename)
 
-    return filtered_images
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from utils.color_convert import rgb2lab
+from utils.filter_expressiveness import open_reduced
+from utils.palette_store import file_hash
+
+# rgb is (h, w, 3) uint8, lab is (h, w, 3) float32 CIELAB
+# (L in [0, 100], a and b in [-128, 127]), as accepted by every utils module
+DecodedImage = namedtuple("DecodedImage", ["rgb", "lab"])
+
+
+def decode_image(path, max_size=None):
+    """Decodes an image to uint8 RGB and float32 LAB arrays.
+    Args:
+        path The path of the image.
+        max_size Longest side wanted, None keeps the full resolution.
+                 The image is reduced by utils.filter_expressiveness.open_reduced.
+    """
+    pixels = np.asarray(open_reduced(path, max_size))
+    return DecodedImage(pixels, rgb2lab(pixels))
+
+
+class ImageCache(object):
+    """Decoded images shared by the stages of a pipeline run.
+
+    Images are decoded by decode_image at the max_size asked for, so a cached image
+    holds the same pixels as a direct decode, and small sizes keep the fast JPEG
+    draft decode. Each (file, max_size) pair is decoded once.
+
+    Decoded arrays are kept in an in-memory LRU bounded by max_bytes. The latest
+    decode is kept even when it alone is larger, so the next stage asking for a
+    large image still gets it from memory. With disk_dir, decodes are also written
+    as .npy files named after the file content hash and max_size, and read back
+    memory-mapped, so other processes (pool workers, later stages) reuse them
+    instead of decoding again.
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, max_size=None):
+        """Returns the DecodedImage of path, decoding it only if no cache has it."""
+        stat = os.stat(path)
+        key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns, max_size)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        self.misses += 1
+
+        if self.disk_dir is None:
+            decoded = decode_image(path, max_size)
+        else:
+            decoded = self._get_from_disk(path, max_size)
+        self._remember(key, decoded)
+        return decoded
+
+    def _get_from_disk(self, path, max_size):
+        stem = os.path.join(self.disk_dir, "%s-%s" % (file_hash(path), max_size or "full"))
+        rgb_path = stem + ".rgb.npy"
+        lab_path = stem + ".lab.npy"
+        if not (os.path.isfile(rgb_path) and os.path.isfile(lab_path)):
+            decoded = decode_image(path, max_size)
+            if not os.path.exists(self.disk_dir):
+                os.makedirs(self.disk_dir, exist_ok=True)
+            for array, array_path in ((decoded.rgb, rgb_path), (decoded.lab, lab_path)):
+                # Written under a process-unique name, then renamed, so concurrent workers never read a partial file
+                tmp_path = "%s.%d.tmp.npy" % (array_path[:-len(".npy")], os.getpid())
+                np.save(tmp_path, array)
+                os.replace(tmp_path, array_path)
+        return DecodedImage(np.load(rgb_path, mmap_mode="r"), np.load(lab_path, mmap_mode="r"))
+
+    def _remember(self, key, decoded):
+        # Memory-mapped arrays cost no heap, but they are counted so the LRU also bounds open maps.
+        # The new entry is never evicted by itself: the caller holds it anyway
+        size = decoded.rgb.nbytes + decoded.lab.nbytes
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = decoded
+            self.nbytes += size
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.rgb.nbytes + evicted.lab.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+# One cache per disk directory and process, shared by the stages running in it
+_caches = {}
+
+
+def get_cache(disk_dir=None):
+    if disk_dir not in _caches:
+        _caches[disk_dir] = ImageCache(disk_dir=disk_dir)
+    return _caches[disk_dir]
+
+
+def load_image(path, max_size=None, disk_dir=None):
+    """Returns the DecodedImage of path from the process-wide cache for disk_dir."""
+    return get_cache(disk_dir).get(path, max_size)
@@ -0,0 +1,276 @@
+import argparse
+import atexit
+import cProfile
+import functools
+import json
+import os
+import re
+import threading
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+# Stage timers and counters, written as JSON lines.
+#   SKY_METRICS=metrics.jsonl       enables them and appends the lines to that file
+#   SKY_PROFILE=cprofile,tracemalloc also captures a cProfile dump and/or the peak traced
+#                                   memory of every image, dumps go to SKY_PROFILE_DIR
+#                                   (default: "<metrics file>.profiles")
+# Each image_context writes one line {"image", "seconds", "stages", "counters", ...},
+# and each process appends a {"summary"} line with the percentiles of the stages it timed
+# when it exits: through atexit in the main process, and through a multiprocessing
+# finalizer in worker processes, which leave with os._exit and skip atexit (pools must be
+# closed and joined rather than terminated for their workers to write it, as
+# utils.parallel.imap_jobs does).
+# python -m utils.instrument metrics.jsonl aggregates the image lines of every process.
+# While disabled, timers and decorators cost one attribute check.
+
+_NULL = nullcontext()
+
+
+class _Recorder(object):
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.profile = ()
+        self.profile_dir = None
+        self.durations = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+
+_recorder = _Recorder()
+
+
+def enable(path, profile=(), profile_dir=None):
+    """Starts recording.
+    Args:
+        path JSON-lines file the metrics are appended to
+        profile Per-image captures, any of "cprofile" and "tracemalloc"
+        profile_dir Directory of the cProfile dumps
+    """
+    _recorder.path = path
+    _recorder.profile = tuple(profile)
+    _recorder.profile_dir = profile_dir or path + ".profiles"
+    if not _recorder.enabled:
+        _recorder.enabled = True
+        atexit.register(write_summary)
+        from multiprocessing import util
+        util.register_after_fork(_recorder, _after_fork)
+
+
+def _after_fork(recorder):
+    # Runs in every new multiprocessing child, forked or spawned: it starts with empty
+    # statistics (the parent reports its own) and writes its summary when it finishes
+    from multiprocessing import util
+    recorder.durations = {}
+    recorder.counters = {}
+    recorder.lock = threading.Lock()
+    recorder.local = threading.local()
+    util.Finalize(None, write_summary, exitpriority=0)
+
+
+def disable():
+    _recorder.enabled = False
+
+
+def is_enabled():
+    return _recorder.enabled
+
+
+def _record(name, seconds):
+    with _recorder.lock:
+        _recorder.durations.setdefault(name, []).append(seconds)
+    record = getattr(_recorder.local, "record", None)
+    if record is not None:
+        stage = record["stages"].setdefault(name, {"seconds": 0.0, "calls": 0})
+        stage["seconds"] += seconds
+        stage["calls"] += 1
+
+
+class _Timer(object):
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        _record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def timer(name):
+    """Context manager adding the time spent in its block to the stage `name`."""
+    if not _recorder.enabled:
+        return _NULL
+    return _Timer(name)
+
+
+def timed(name):
+    """Decorator timing every call of a function as the stage `name`."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _recorder.enabled:
+                return function(*args, **kwargs)
+            with _Timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, n=1):
+    """Adds n to the counter `name`."""
+    if not _recorder.enabled:
+        return
+    with _recorder.lock:
+        _recorder.counters[name] = _recorder.counters.get(name, 0) + n
+    record = getattr(_recorder.local, "record", None)
+    if record is not None:
+        record["counters"][name] = record["counters"].get(name, 0) + n
+
+
+class _ImageContext(object):
+    def __init__(self, name):
+        self.record = {"image": name, "pid": os.getpid(), "stages": {}, "counters": {}}
+        self.profiler = None
+
+    def __enter__(self):
+        _recorder.local.record = self.record
+        if "tracemalloc" in _recorder.profile:
+            # The peak covers every thread of the process, so it is exact with one image at a time
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        if "cprofile" in _recorder.profile:
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # Only one profiler can be active at once (Python 3.12+), other threads go without
+                self.profiler = None
+        self.start = time.perf_counter()
+        return self.record
+
+    def __exit__(self, exc_type, exc, traceback):
+        record = self.record
+        record["seconds"] = time.perf_counter() - self.start
+        if self.profiler is not None:
+            self.profiler.disable()
+            os.makedirs(_recorder.profile_dir, exist_ok=True)
+            safe_name = re.sub(r"[^\w.-]", "_", str(record["image"]))
+            self.profiler.dump_stats(os.path.join(_recorder.profile_dir, "%s-%d.prof" % (safe_name, os.getpid())))
+        if "tracemalloc" in _recorder.profile:
+            record["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        if exc is not None:
+            record["error"] = repr(exc)
+        _recorder.local.record = None
+        _write_line(record)
+        return False
+
+
+def record_error(exc):
+    """Marks the current image as failed, for errors handled inside its image_context."""
+    record = getattr(_recorder.local, "record", None)
+    if record is not None:
+        record["error"] = repr(exc)
+
+
+def image_context(name):
+    """Context manager collecting the stages and counters of one image into a metrics line."""
+    if not _recorder.enabled:
+        return _NULL
+    return _ImageContext(name)
+
+
+def _write_line(data):
+    line = json.dumps(data) + "\n"
+    # A single append of a short line, so the lines of concurrent processes do not interleave
+    with _recorder.lock, open(_recorder.path, "a") as f:
+        f.write(line)
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Returns {"count", "total", "p50", ..., "max"} of a list of durations (nearest rank)."""
+    ordered = sorted(values)
+    summary = {"count": len(ordered), "total": sum(ordered), "max": ordered[-1]}
+    for point in points:
+        rank = max(0, -(-point * len(ordered) // 100) - 1)
+        summary["p%d" % point] = ordered[rank]
+    return summary
+
+
+def summary():
+    """Returns the percentiles of every stage timed in this process, and its counters."""
+    with _recorder.lock:
+        stages = {name: percentiles(values) for name, values in _recorder.durations.items() if values}
+        return {"stages": stages, "counters": dict(_recorder.counters)}
+
+
+def write_summary():
+    if _recorder.enabled and _recorder.durations:
+        data = summary()
+        data["pid"] = os.getpid()
+        _write_line({"summary": data})
+
+
+def summarize(path):
+    """Aggregates the image lines of a metrics file, whatever process wrote them.
+    Returns:
+        {"images", "errors", "seconds": percentiles of the image totals,
+         "stages": stage -> percentiles of the per-image stage times, "counters": totals}
+    """
+    totals = []
+    stages = {}
+    counters = {}
+    errors = 0
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if "image" not in record:
+                continue
+            totals.append(record["seconds"])
+            errors += "error" in record
+            for name, stage in record["stages"].items():
+                stages.setdefault(name, []).append(stage["seconds"])
+            for name, n in record["counters"].items():
+                counters[name] = counters.get(name, 0) + n
+    return {
+        "images": len(totals),
+        "errors": errors,
+        "seconds": percentiles(totals) if totals else None,
+        "stages": {name: percentiles(values) for name, values in stages.items()},
+        "counters": counters,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize a metrics file written with SKY_METRICS")
+    parser.add_argument("metrics", help="JSON-lines metrics file")
+    args = parser.parse_args(argv)
+
+    result = summarize(args.metrics)
+    print("%d images, %d errors" % (result["images"], result["errors"]))
+    rows = sorted(result["stages"].items())
+    if result["seconds"] is not None:
+        rows.insert(0, ("(image total)", result["seconds"]))
+    print("%-24s %7s %10s %10s %10s %10s %10s" % ("stage", "images", "total s", "p50", "p90", "p99", "max"))
+    for name, stage in rows:
+        print("%-24s %7d %10.3f %10.4f %10.4f %10.4f %10.4f" % (
+            name, stage["count"], stage["total"], stage["p50"], stage["p90"], stage["p99"], stage["max"]))
+    for name, n in sorted(result["counters"].items()):
+        print("%-24s %d" % (name, n))
+
+
+if os.environ.get("SKY_METRICS"):
+    enable(os.environ["SKY_METRICS"],
+           [p for p in os.environ.get("SKY_PROFILE", "").split(",") if p],
+           os.environ.get("SKY_PROFILE_DIR"))
+
+
+if __name__ == "__main__":
+    main()
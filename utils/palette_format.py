@@ -0,0 +1,177 @@
+import os
+import struct
+
+import numpy as np
+
+from utils.color_convert import rgb2lab
+from utils.color_entropy import encode_lab
+from utils.instrument import timed
+from utils.palette_store import shard_of, write_json_atomic
+
+# Packed palette file layout (little-endian):
+#   header   MAGIC, version, dtype code, space code, number of images,
+#            then the byte offsets of the string table, the index and the colors
+#   strings  utf-8 image names back to back
+#   index    one INDEX_DTYPE row per image: where its name and colors are
+#   colors   (total colors, 3) array of uint8 or float16, the palettes back to back
+MAGIC = b"SKYP"
+VERSION = 1
+HEADER = struct.Struct("<4sHBBIQQQ")
+INDEX_DTYPE = np.dtype([("name_offset", "<u4"), ("name_length", "<u4"),
+                        ("color_offset", "<u4"), ("color_count", "<u4")])
+DTYPES = {"uint8": np.dtype("u1"), "float16": np.dtype("<f2")}
+SPACES = ("rgb", "lab")
+# Packed colors start on an 8-byte boundary so the color array can be viewed in place
+ALIGNMENT = 8
+
+
+def palette_array(palette):
+    """Converts a palette ([{"r", "g", "b"}, ...]) to an (n, 3) float array of 0-255 RGB values."""
+    return np.array([[c["r"], c["g"], c["b"]] for c in palette], dtype=np.float64).reshape(-1, 3)
+
+
+def encode_colors(rgb, dtype, space):
+    # uint8 LAB uses utils.color_entropy.encode_lab: L scaled to 0-255, a and b offset by 128
+    if space == "lab":
+        colors = rgb2lab(np.clip(rgb / 255, 0, 1)).astype(np.float64)
+        if dtype == "uint8":
+            return encode_lab(colors)
+    else:
+        colors = rgb
+    if dtype == "uint8":
+        colors = np.clip(np.rint(colors), 0, 255)
+    return colors.astype(DTYPES[dtype])
+
+
+def decode_colors(colors, dtype, space):
+    """Returns float colors in their space: 0-255 RGB or CIELAB."""
+    colors = colors.astype(np.float64)
+    if space == "lab" and dtype == "uint8":
+        # Inverse of encode_lab
+        colors[:, 0] *= 100 / 255
+        colors[:, 1:] -= 128
+    return colors
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+@timed("write_packed")
+def write_packed(palettes, path, dtype="uint8", space="rgb"):
+    """Writes palettes to a packed binary file.
+    Args:
+        palettes Iterable of (image name, palette) or dict image name -> palette
+        path Output path
+        dtype "uint8" (3 bytes per color) or "float16" (6 bytes per color)
+        space "rgb" or "lab", the color space stored
+    Returns:
+        Number of images written
+    """
+    if dtype not in DTYPES or space not in SPACES:
+        raise ValueError("Unknown dtype '%s' or space '%s'" % (dtype, space))
+    if isinstance(palettes, dict):
+        palettes = palettes.items()
+
+    names = []
+    arrays = []
+    for name, palette in palettes:
+        names.append(name.encode("utf-8"))
+        arrays.append(palette_array(palette))
+    index = np.zeros(len(names), dtype=INDEX_DTYPE)
+    name_lengths = np.array([len(name) for name in names], dtype=np.int64)
+    color_counts = np.array([len(array) for array in arrays], dtype=np.int64)
+    index["name_length"] = name_lengths
+    index["name_offset"] = np.cumsum(name_lengths) - name_lengths
+    index["color_count"] = color_counts
+    index["color_offset"] = np.cumsum(color_counts) - color_counts
+    colors = encode_colors(np.concatenate(arrays) if arrays else np.zeros((0, 3)), dtype, space)
+
+    strings = b"".join(names)
+    strings_offset = HEADER.size
+    index_offset = _aligned(strings_offset + len(strings))
+    data_offset = _aligned(index_offset + index.nbytes)
+    header = HEADER.pack(MAGIC, VERSION, list(DTYPES).index(dtype), SPACES.index(space), len(names),
+                         strings_offset, index_offset, data_offset)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(strings)
+        f.write(b"\0" * (index_offset - strings_offset - len(strings)))
+        f.write(index.tobytes())
+        f.write(b"\0" * (data_offset - index_offset - index.nbytes))
+        f.write(colors.tobytes())
+    os.replace(tmp_path, path)
+    return len(names)
+
+
+class PackedPalettes(object):
+    """Memory-mapped reader of a file written by write_packed.
+    Nothing but the header is read up front; names and colors are views into the map."""
+
+    def __init__(self, path):
+        self.buffer = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, version, dtype_code, space_code, count, strings_offset, index_offset, data_offset = \
+            HEADER.unpack(self.buffer[:HEADER.size].tobytes())
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("'%s' is not a packed palette file" % (path,))
+        self.dtype = list(DTYPES)[dtype_code]
+        self.space = SPACES[space_code]
+        self.strings = self.buffer[strings_offset:index_offset]
+        self.index = self.buffer[index_offset:index_offset + count * INDEX_DTYPE.itemsize].view(INDEX_DTYPE)
+        self.colors = self.buffer[data_offset:].view(DTYPES[self.dtype]).reshape(-1, 3)
+        self._positions = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def name(self, i):
+        start = self.index["name_offset"][i]
+        return self.strings[start:start + self.index["name_length"][i]].tobytes().decode("utf-8")
+
+    def colors_of(self, i):
+        """Returns the stored colors of image i as a float array (0-255 RGB or CIELAB)."""
+        start = self.index["color_offset"][i]
+        return decode_colors(self.colors[start:start + self.index["color_count"][i]], self.dtype, self.space)
+
+    def __getitem__(self, name):
+        if self._positions is None:
+            self._positions = {self.name(i): i for i in range(len(self))}
+        return self.colors_of(self._positions[name])
+
+    def items(self):
+        for i in range(len(self)):
+            yield self.name(i), self.colors_of(i)
+
+
+def shard_paths(path, shards):
+    stem, ext = os.path.splitext(path)
+    return ["%s-%d%s" % (stem, i, ext) for i in range(shards)]
+
+
+def write_sharded(palettes, path, shards, dtype="uint8", space="rgb"):
+    """Writes palettes to `shards` packed files, spread by a hash of the image name
+    (see utils.palette_store.shard_of), so a client only fetches the shard it needs.
+    Returns:
+        List of the written paths
+    """
+    if isinstance(palettes, dict):
+        palettes = palettes.items()
+    parts = [[] for _ in range(shards)]
+    for name, palette in palettes:
+        parts[shard_of(name, shards)].append((name, palette))
+    paths = shard_paths(path, shards)
+    for part, shard_path in zip(parts, paths):
+        write_packed(part, shard_path, dtype, space)
+    return paths
+
+
+def write_compact_json(palettes, path, ndigits=1):
+    """Writes palettes in the data.json format with rounded values and no whitespace."""
+    if not isinstance(palettes, dict):
+        palettes = dict(palettes)
+    compact = {name: [{channel: round(float(c[channel]), ndigits) for channel in ("r", "g", "b")}
+                      for c in palette]
+               for name, palette in palettes.items()}
+    write_json_atomic(path, compact, separators=(",", ":"))
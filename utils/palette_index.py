@@ -0,0 +1,195 @@
+import argparse
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from utils.color_convert import rgb2lab
+
+
+def palette_to_lab(palette):
+    """Converts a palette ([{"r", "g", "b"}, ...] with 0-255 values) to an (n, 3) LAB array."""
+    rgb = np.array([[c["r"], c["g"], c["b"]] for c in palette], dtype=np.float64).reshape(-1, 3)
+    return rgb2lab(np.clip(rgb / 255, 0, 1)).astype(np.float64)
+
+
+def hex_to_lab(hex_color):
+    hex_color = hex_color.lstrip("#")
+    rgb = [int(hex_color[i:i + 2], 16) for i in (0, 2, 4)]
+    return palette_to_lab([{"r": rgb[0], "g": rgb[1], "b": rgb[2]}])[0]
+
+
+def resample_matrix(size, length):
+    """(length, size) matrix that linearly resamples an ordered palette of size colors
+    to length colors, so palettes of different sizes can be compared segment by segment."""
+    if size == 1:
+        return np.ones((length, 1))
+    source = np.linspace(0, 1, size)
+    target = np.linspace(0, 1, length)
+    return np.column_stack([np.interp(target, source, basis) for basis in np.eye(size)])
+
+
+def resample_palette(lab, length):
+    return resample_matrix(len(lab), length) @ lab
+
+
+def resample_palettes(all_lab, sizes, length):
+    """Resamples many palettes stored back to back in all_lab, one matrix product per palette size."""
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    resampled = np.empty((len(sizes), length, 3))
+    for size in np.unique(sizes):
+        which = np.flatnonzero(sizes == size)
+        stacked = all_lab[starts[which][:, None] + np.arange(size)]
+        resampled[which] = np.einsum("ls,psc->plc", resample_matrix(size, length), stacked)
+    return resampled
+
+
+class PaletteIndex(object):
+    """Nearest-neighbour search over the palettes of data.json.
+
+    Two KD-trees are built over LAB colors, where Euclidean distance is delta E (CIE76):
+        colors   every palette color, for "skies containing this color"
+        palettes every palette resampled to key_length colors and flattened, for
+                 "skies with this palette"; the candidates it returns are re-ranked
+                 by the mean delta E of their palettes resampled to length segments
+    A short key keeps the palette tree low-dimensional, where KD-trees stay fast.
+    """
+
+    def __init__(self, palettes, length=10, key_length=4):
+        """
+        Args:
+            palettes Dict image name -> palette, as stored in data.json
+            length Number of segments palettes are compared on
+            key_length Number of segments of the palette tree keys
+        """
+        from scipy.spatial import cKDTree
+
+        self.length = length
+        self.key_length = key_length
+        self.names = [name for name, palette in palettes.items() if len(palette) > 0]
+        if not self.names:
+            # An empty data.json, or one with only empty palettes, answers every query with no results
+            self.color_tree = self.palette_tree = None
+            return
+        sizes = np.array([len(palettes[name]) for name in self.names])
+        # One rgb2lab call for every color of every palette
+        all_lab = palette_to_lab([c for name in self.names for c in palettes[name]])
+
+        self.color_owner = np.repeat(np.arange(len(self.names)), sizes)
+        self.color_tree = cKDTree(all_lab)
+        self.max_palette_size = sizes.max()
+
+        self.segments = resample_palettes(all_lab, sizes, length)
+        keys = resample_palettes(all_lab, sizes, key_length)
+        self.palette_tree = cKDTree(keys.reshape(len(sizes), -1))
+
+    @classmethod
+    def from_json(cls, path, length=10):
+        with open(path) as f:
+            return cls(json.load(f), length)
+
+    def query_color(self, lab, k=10):
+        """Returns the k images with the palette color closest to lab.
+        Returns:
+            List of (image name, delta E) sorted by distance
+        """
+        k = min(k, len(self.names))
+        if k < 1:
+            return []
+        n_colors = self.color_tree.n
+        # An image appears once per palette color, so ask for enough neighbours to get k images
+        n = min(k * self.max_palette_size, n_colors)
+        while True:
+            distances, indices = self.color_tree.query(lab, k=n)
+            distances = np.atleast_1d(distances)
+            indices = np.atleast_1d(indices)
+            results = []
+            seen = set()
+            for distance, index in zip(distances, indices):
+                owner = self.color_owner[index]
+                if owner not in seen:
+                    seen.add(owner)
+                    results.append((self.names[owner], float(distance)))
+            if len(results) >= k or n == n_colors:
+                return results[:k]
+            n = min(n * 2, n_colors)
+
+    def query_palette(self, lab_palette, k=10, candidates=8):
+        """Returns the k images whose ordered palette is closest to lab_palette.
+        Args:
+            lab_palette (n, 3) LAB array, ordered like the stored palettes
+            k Number of results
+            candidates The KD-tree returns k * candidates palettes that are re-ranked
+        Returns:
+            List of (image name, mean delta E of the aligned segments) sorted by distance
+        """
+        n = min(k * candidates, len(self.names))
+        if n < 1:
+            return []
+        lab_palette = np.asarray(lab_palette, dtype=np.float64)
+        query = resample_palette(lab_palette, self.length)
+        _, indices = self.palette_tree.query(resample_palette(lab_palette, self.key_length).ravel(), k=n)
+        indices = np.atleast_1d(indices)
+        mean_de = np.mean(np.linalg.norm(self.segments[indices] - query, axis=2), axis=1)
+        order = np.argsort(mean_de)[:k]
+        return [(self.names[indices[i]], float(mean_de[i])) for i in order]
+
+
+def make_handler(index):
+    class PaletteQueryHandler(BaseHTTPRequestHandler):
+        """GET /color?hex=ff8800&k=10
+        GET /palette?hex=ff8800,aa4411,...&k=10"""
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            try:
+                k = int(query.get("k", ["10"])[0])
+                hex_colors = query["hex"][0].split(",")
+                if url.path == "/color":
+                    results = index.query_color(hex_to_lab(hex_colors[0]), k)
+                elif url.path == "/palette":
+                    results = index.query_palette(np.array([hex_to_lab(h) for h in hex_colors]), k)
+                else:
+                    self.send_error(404)
+                    return
+            except (KeyError, ValueError, IndexError) as exc:
+                self.send_error(400, str(exc))
+                return
+
+            body = json.dumps([{"name": name, "distance": distance} for name, distance in results]).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return PaletteQueryHandler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve color and palette queries over data.json")
+    parser.add_argument("data", nargs="?", default="data.json", help="palettes JSON file")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--length", type=int, default=10, help="segments palettes are compared on")
+    args = parser.parse_args(argv)
+
+    index = PaletteIndex.from_json(args.data, args.length)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(index))
+    print("Serving %d palettes on http://%s:%d" % (len(index.names), args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import zlib
+
+from utils.filter_expressiveness import IMAGE_EXTENSIONS
+from utils.instrument import image_context, timed
+from utils.parallel import imap_jobs
+
+INDEX_VERSION = 1
+DEFAULT_PARAMS = {"method": "pca_radial", "num_segments": 10, "bits": None, "K": None, "M": None}
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """Returns the sha1 hex digest of a file's content."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def params_key(params):
+    """Returns a short stable key for a dict of extraction parameters."""
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+
+def default_extract(path, params):
+    from utils.pca_radial import extract_file
+    return extract_file(path, num_segments=params["num_segments"], bits=params["bits"],
+                        cache_dir=params.get("cache_dir"))
+
+
+def extract_job(job):
+    """Runs extract(path, params) on one image, for imap_jobs.
+    Args:
+        job (extract, name, path, params)
+    Returns:
+        (name, palette, None), or (name, None, exception) if the image could not be read
+    """
+    from PIL import Image
+    extract, name, path, params = job
+    try:
+        with image_context(name):
+            return name, extract(path, params), None
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as exc:
+        return name, None, exc
+
+
+@timed("write_json")
+def write_json_atomic(path, data, **kwargs):
+    # Write next to the target and rename, so readers never see a partial file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, **kwargs)
+    os.replace(tmp_path, path)
+
+
+class PaletteStore(object):
+    """On-disk palette cache keyed by image content hash and extraction parameters.
+
+    The index (root/index.json) holds
+        files    image name -> {"hash", "size", "mtime"} of the last time it was seen
+        palettes "<content hash>-<params key>" -> palette
+    Only images whose content or parameters changed are recomputed on refresh,
+    and palettes no image refers to anymore are evicted.
+    """
+
+    def __init__(self, root, **params):
+        self.root = root
+        self.params = dict(DEFAULT_PARAMS, **params)
+        self.key = params_key(self.params)
+        self.index_path = os.path.join(root, "index.json")
+        self.files = {}
+        self.palettes = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if index.get("version") == INDEX_VERSION:
+                self.files = index["files"]
+                self.palettes = index["palettes"]
+
+    def entry_key(self, content_hash):
+        return "%s-%s" % (content_hash, self.key)
+
+    def content_hash(self, name, path):
+        # Re-hashing is skipped while size and mtime are unchanged
+        stat = os.stat(path)
+        known = self.files.get(name)
+        if known is not None and known["size"] == stat.st_size and known["mtime"] == stat.st_mtime_ns:
+            return known["hash"]
+        content_hash = file_hash(path)
+        self.files[name] = {"hash": content_hash, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+        return content_hash
+
+    def refresh(self, images_dir, extract=default_extract, workers=1):
+        """Brings the store up to date with a directory of images.
+        Args:
+            images_dir The directory containing the images.
+            extract Callable (path, params) -> palette used for new or changed images.
+                    It must be a module-level function when workers is not 1.
+            workers Number of processes extracting palettes, None for all CPUs.
+        Returns:
+            Dict with the number of "computed", "cached" and "evicted" palettes.
+        """
+        names = sorted(f for f in os.listdir(images_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+        stats = {"computed": 0, "cached": 0, "evicted": 0}
+
+        # Forget files that are gone
+        for name in set(self.files) - set(names):
+            del self.files[name]
+
+        jobs = []
+        for name in names:
+            path = os.path.join(images_dir, name)
+            key = self.entry_key(self.content_hash(name, path))
+            if key in self.palettes:
+                stats["cached"] += 1
+            else:
+                jobs.append((extract, name, path, self.params))
+
+        self._store_results(imap_jobs(extract_job, jobs, workers, ordered=False), stats)
+
+        live = set(self.entry_key(entry["hash"]) for entry in self.files.values())
+        for key in set(self.palettes) - live:
+            del self.palettes[key]
+            stats["evicted"] += 1
+
+        self.save()
+        return stats
+
+    def _store_results(self, results, stats):
+        for name, palette, exc in results:
+            if exc is not None:
+                # Unreadable images are left out of the store and retried on the next refresh
+                print("[Warning] could not extract '%s': %s" % (name, exc))
+                del self.files[name]
+                continue
+            self.palettes[self.entry_key(self.files[name]["hash"])] = palette
+            stats["computed"] += 1
+
+    def save(self):
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        write_json_atomic(self.index_path, {
+            "version": INDEX_VERSION,
+            "params": self.params,
+            "files": self.files,
+            "palettes": self.palettes,
+        })
+
+    def items(self):
+        """Yields (image name, palette) for every image in the store."""
+        for name in sorted(self.files):
+            palette = self.palettes.get(self.entry_key(self.files[name]["hash"]))
+            if palette is not None:
+                yield name, palette
+
+    def export_json(self, path, shards=None):
+        """Writes the palettes in the data.json format ({image name: palette}).
+        Args:
+            path Output path, e.g. "data.json"
+            shards Optional number of shards; images are spread by a hash of their
+                   name over "<path stem>-<i>.json" files
+        Returns:
+            List of the written paths
+        """
+        if not shards:
+            write_json_atomic(path, dict(self.items()))
+            return [path]
+
+        stem, ext = os.path.splitext(path)
+        parts = [{} for _ in range(shards)]
+        for name, palette in self.items():
+            parts[shard_of(name, shards)][name] = palette
+        paths = []
+        for i, part in enumerate(parts):
+            shard_path = "%s-%d%s" % (stem, i, ext)
+            write_json_atomic(shard_path, part)
+            paths.append(shard_path)
+        return paths
+
+
+def shard_of(name, shards):
+    """Returns the shard an image name belongs to, stable across runs and machines."""
+    return zlib.crc32(name.encode("utf-8")) % shards
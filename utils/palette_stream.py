@@ -0,0 +1,302 @@
+import argparse
+import os
+
+import numpy as np
+
+from utils.color_histogram import bin_index
+from utils.filter_expressiveness import IMAGE_EXTENSIONS
+from utils.pca_radial import angle_segments, principal_axes, segment_palette
+
+# Out-of-core PCA radial palettes (see utils.pca_radial). An image is read as strips of
+# rows and a PaletteAccumulator keeps, in one pass and a fixed amount of memory:
+#   the pixel count and sum, and the 3x3 sum of outer products, for the exact mean
+#   and covariance of the PCA
+#   a color histogram with bits bits per channel (count and color sums per bin), whose
+#   bins are assigned to the angular segments once the PCA is known
+# With exact=True a second pass assigns every pixel itself, which gives the palette of
+# extract_color_pca_radial exactly.
+# Memory stays flat for .npy sources and numpy memmaps, which are read strip by strip, and
+# for striped or tiled 8-bit TIFF files, decoded one row of strips or tiles at a time with
+# tifffile when it is installed (see TiffBands). Other image files (JPEG, PNG, ...) are
+# decoded by PIL as a whole (3 bytes per pixel) before streaming, and those above PIL's
+# Image.MAX_IMAGE_PIXELS bomb limit are refused with a ValueError.
+
+LARGE_IMAGE_HINT = ("JPEG and PNG files are decoded whole: convert very large images to a tiled or "
+                    "striped TIFF (e.g. vips tiffsave --tile) or to an (h, w, 3) uint8 .npy file "
+                    "to stream them in constant memory")
+
+# Pixels read at once, whatever the image width
+STRIP_PIXELS = 1 << 18
+# Compressed TIFF bytes tifffile reads from the file at once
+TIFF_READ_BYTES = 1 << 22
+
+
+class TiffBands(object):
+    """(h, w, 3) uint8 image of a striped or tiled TIFF file, decoded by bands():
+    one row of strips or tiles at a time, so memory is bounded by one band."""
+
+    def __init__(self, path, shape, gray):
+        self.path = path
+        self.shape = shape
+        self.gray = gray
+
+    @classmethod
+    def open(cls, path):
+        """Returns the TiffBands of path, or None when tifffile is not installed or cannot
+        stream the file: its first page must hold 8-bit gray or RGB(A) samples, interleaved,
+        in a compression tifffile decodes (LZW and JPEG need imagecodecs)."""
+        try:
+            import tifffile
+        except ImportError:
+            return None
+        try:
+            with tifffile.TiffFile(path) as tif:
+                page = tif.pages.first
+                if page.dtype != np.uint8 or page.compression not in tifffile.TIFF.DECOMPRESSORS or \
+                        page.photometric not in (tifffile.PHOTOMETRIC.MINISBLACK, tifffile.PHOTOMETRIC.RGB) or \
+                        (page.samplesperpixel > 1 and page.planarconfig != tifffile.PLANARCONFIG.CONTIG):
+                    return None
+                return cls(path, (int(page.imagelength), int(page.imagewidth), 3),
+                           page.photometric == tifffile.PHOTOMETRIC.MINISBLACK)
+        except tifffile.TiffFileError:
+            # Not a TIFF after all, PIL gets to try
+            return None
+
+    def bands(self):
+        """Yields the image from top to bottom as (rows, w, 3) uint8 arrays, one per row of
+        strips or tiles."""
+        import tifffile
+
+        h, w, _ = self.shape
+        band = None
+        with tifffile.TiffFile(self.path) as tif:
+            # Segments come in row-major order, edge tiles are padded past the image
+            for segment, (_, _, y, x, _), shape in tif.pages.first.segments(maxworkers=1,
+                                                                              buffersize=TIFF_READ_BYTES):
+                rows = min(shape[1], h - y)
+                cols = min(shape[2], w - x)
+                if band is None:
+                    band = np.zeros((rows, w, 3), dtype=np.uint8)
+                if segment is not None:
+                    # Missing segments of sparse files stay black, a gray sample fills all three channels
+                    band[:, x:x + cols] = segment[0, :rows, :cols, :1 if self.gray else 3]
+                if x + cols >= w:
+                    yield band
+                    band = None
+
+
+def open_source(source):
+    """Returns an (h, w, >=3) array view of a source without copying it, or the TiffBands
+    of a TIFF file that can be decoded band by band.
+    Args:
+        source Path of an image or of a .npy file (memory-mapped), PIL image,
+               utils.image_cache.DecodedImage or array of 0-255 RGB values
+    """
+    if isinstance(source, str):
+        if source.endswith(".npy"):
+            return np.load(source, mmap_mode="r")
+        if source.lower().endswith((".tif", ".tiff")):
+            bands = TiffBands.open(source)
+            if bands is not None:
+                return bands
+        from PIL import Image
+        try:
+            source = Image.open(source)
+        except Image.DecompressionBombError as exc:
+            raise ValueError("%s; %s" % (exc, LARGE_IMAGE_HINT))
+    if hasattr(source, "convert"):
+        if source.mode != "RGB":
+            source = source.convert("RGB")
+        return np.asarray(source)
+    if hasattr(source, "rgb"):
+        return source.rgb
+    return source
+
+
+def iter_strips(source, rows=None):
+    """Yields the pixels of a source as (n, 3) float64 arrays of at most rows image rows,
+    by default as many rows as fit in STRIP_PIXELS."""
+    array = open_source(source)
+    if rows is None:
+        rows = max(1, STRIP_PIXELS // max(array.shape[1], 1))
+    # A TiffBands is decoded again on every pass, a strip never spans two of its bands
+    for band in (array.bands() if hasattr(array, "bands") else [array]):
+        for start in range(0, band.shape[0], rows):
+            strip = np.asarray(band[start:start + rows])
+            yield strip[..., :3].reshape(-1, 3).astype(np.float64)
+
+
+class PaletteAccumulator(object):
+    """One-pass statistics of a stream of RGB pixels, from which palette() is computed."""
+
+    def __init__(self, bits=6, num_segments=10):
+        self.bits = bits
+        self.num_segments = num_segments
+        self.count = 0
+        # Moments are taken around the mean of the first batch, which keeps
+        # the covariance free of cancellation on very large images
+        self.shift = None
+        self.sum = np.zeros(3)
+        self.outer = np.zeros((3, 3))
+        self.bin_counts = np.zeros(1 << (3 * bits))
+        self.bin_sums = np.zeros((1 << (3 * bits), 3))
+
+    def update(self, pixels):
+        """Adds an (n, 3) array of 0-255 RGB pixels."""
+        pixels = np.asarray(pixels, dtype=np.float64).reshape(-1, 3)
+        if len(pixels) == 0:
+            return self
+        if self.shift is None:
+            self.shift = pixels.mean(axis=0)
+        shifted = pixels - self.shift
+        self.count += len(pixels)
+        self.sum += shifted.sum(axis=0)
+        self.outer += shifted.T @ shifted
+
+        index = bin_index(pixels, self.bits)
+        n_bins = len(self.bin_counts)
+        self.bin_counts += np.bincount(index, minlength=n_bins)
+        for channel in range(3):
+            self.bin_sums[:, channel] += np.bincount(index, weights=pixels[:, channel], minlength=n_bins)
+        return self
+
+    def merge(self, other):
+        """Adds the statistics of another accumulator, e.g. of a tile processed elsewhere."""
+        if other.count == 0:
+            return self
+        if self.shift is None:
+            self.shift = other.shift.copy()
+        # Re-center the other moments on this shift
+        delta = other.shift - self.shift
+        other_sum = other.sum + other.count * delta
+        self.outer += other.outer + np.outer(other.sum, delta) + np.outer(delta, other.sum) + \
+            other.count * np.outer(delta, delta)
+        self.sum += other_sum
+        self.count += other.count
+        self.bin_counts += other.bin_counts
+        self.bin_sums += other.bin_sums
+        return self
+
+    @property
+    def mean(self):
+        return self.shift + self.sum / self.count
+
+    @property
+    def covariance(self):
+        centered_mean = self.sum / self.count
+        return self.outer / self.count - np.outer(centered_mean, centered_mean)
+
+    def axes(self):
+        return principal_axes(self.covariance)
+
+    def palette(self):
+        """Returns the palette, with the histogram bins assigned to the segments by their mean color."""
+        if self.count == 0:
+            return []
+        occupied = np.flatnonzero(self.bin_counts)
+        counts = self.bin_counts[occupied]
+        sums = self.bin_sums[occupied]
+        components = (sums / counts[:, None] - self.mean) @ self.axes().T
+        # The mean of the projected pixels is 0 by construction
+        segments = angle_segments(components, np.zeros(2), self.num_segments)
+        segment_weights = np.bincount(segments, weights=counts, minlength=self.num_segments)
+        segment_sums = np.column_stack([np.bincount(segments, weights=sums[:, channel], minlength=self.num_segments)
+                                        for channel in range(3)])
+        return segment_palette(segment_weights, segment_sums)
+
+
+def stream_palette(source, num_segments=10, bits=6, rows=None, exact=False):
+    """Extracts the PCA radial palette of an image strip by strip.
+    Args:
+        source See open_source
+        num_segments Number of angular segments
+        bits Bits per channel of the histogram used to assign pixels to segments
+        rows Image rows read at once, None for STRIP_PIXELS pixels
+        exact Assign every pixel in a second pass instead of by histogram bin
+    Returns:
+        List of {"r", "g", "b"} dicts, as extract_color_pca_radial
+    """
+    array = open_source(source)
+    accumulator = PaletteAccumulator(bits, num_segments)
+    for pixels in iter_strips(array, rows):
+        accumulator.update(pixels)
+    if not exact or accumulator.count == 0:
+        return accumulator.palette()
+
+    mean = accumulator.mean
+    axes = accumulator.axes()
+    segment_weights = np.zeros(num_segments)
+    segment_sums = np.zeros((num_segments, 3))
+    for pixels in iter_strips(array, rows):
+        segments = angle_segments((pixels - mean) @ axes.T, np.zeros(2), num_segments)
+        segment_weights += np.bincount(segments, minlength=num_segments)
+        for channel in range(3):
+            segment_sums[:, channel] += np.bincount(segments, weights=pixels[:, channel], minlength=num_segments)
+    return segment_palette(segment_weights, segment_sums)
+
+
+def iter_frames(frames):
+    """Yields (name, source) for every frame of a sequence.
+    Args:
+        frames Directory of images (sorted by name), .npy file of a (t, h, w, 3) stack
+               (memory-mapped), or an iterable of sources (see open_source)
+    """
+    if isinstance(frames, str) and os.path.isdir(frames):
+        for name in sorted(os.listdir(frames)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield name, os.path.join(frames, name)
+        return
+    if isinstance(frames, str) and frames.endswith(".npy"):
+        frames = np.load(frames, mmap_mode="r")
+    for i, frame in enumerate(frames):
+        yield (os.path.basename(frame) if isinstance(frame, str) else str(i)), frame
+
+
+def iter_frame_palettes(frames, num_segments=10, bits=6, rows=None, exact=False):
+    """Yields (frame name, palette) for a time-lapse sequence, one frame in memory at a time.
+    Unreadable frames are skipped."""
+    for name, frame in iter_frames(frames):
+        try:
+            palette = stream_palette(frame, num_segments, bits, rows, exact)
+        except (OSError, ValueError, SyntaxError) as exc:
+            print("[Warning] could not extract frame '%s': %s" % (name, exc))
+            continue
+        yield name, palette
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract palettes of very large images or frame sequences "
+                                                 "in constant memory",
+                                     epilog="Memory is constant for .npy sources and striped or tiled TIFF "
+                                            "files; " + LARGE_IMAGE_HINT + " (images above PIL's decompression "
+                                            "bomb limit are refused).")
+    parser.add_argument("sources", nargs="+",
+                        help="images, .npy arrays or frame stacks, or directories of frames")
+    parser.add_argument("-o", "--output", default="data.json", help="output file")
+    parser.add_argument("--segments", type=int, default=10, help="number of angular segments")
+    parser.add_argument("--bits", type=int, default=6, help="bits per channel of the streaming histogram")
+    parser.add_argument("--rows", type=int, default=None, help="image rows read at once (default: about %d pixels)"
+                        % (STRIP_PIXELS,))
+    parser.add_argument("--exact", action="store_true", help="second pass assigning every pixel exactly")
+    args = parser.parse_args(argv)
+
+    from utils.pca_radial import write_palettes
+
+    def palettes():
+        for source in args.sources:
+            if os.path.isdir(source) or (source.endswith(".npy") and np.load(source, mmap_mode="r").ndim == 4):
+                for name, palette in iter_frame_palettes(source, args.segments, args.bits, args.rows, args.exact):
+                    yield "%s/%s" % (os.path.basename(source.rstrip("/")), name), palette
+            else:
+                try:
+                    palette = stream_palette(source, args.segments, args.bits, args.rows, args.exact)
+                except (OSError, ValueError, SyntaxError) as exc:
+                    print("[Warning] could not extract '%s': %s" % (source, exc))
+                    continue
+                yield os.path.basename(source), palette
+
+    print("Wrote %d palettes to %s" % (write_palettes(palettes(), args.output), args.output))
+
+
+if __name__ == "__main__":
+    main()
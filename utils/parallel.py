@@ -0,0 +1,23 @@
+from multiprocessing import Pool
+
+
+def imap_jobs(function, jobs, workers=None, chunksize=1, ordered=True):
+    """Yields function(job) for every job of a list, on a process pool.
+    Args:
+        function Module-level function, so it can be sent to the workers
+        jobs List of job arguments
+        workers Number of worker processes, defaults to the number of CPUs.
+                1, or fewer than two jobs, runs them in the current process.
+        chunksize Number of jobs sent to a worker at once.
+        ordered Yield the results in job order instead of as soon as they are ready.
+    """
+    if workers == 1 or len(jobs) < 2:
+        yield from map(function, jobs)
+        return
+
+    with Pool(workers) as pool:
+        imap = pool.imap if ordered else pool.imap_unordered
+        yield from imap(function, jobs, chunksize)
+        # Lets the workers exit normally, so they write their metrics summary
+        pool.close()
+        pool.join()
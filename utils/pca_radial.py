@@ -0,0 +1,240 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+from utils.color_histogram import get_rgb_array, quantize_colors
+from utils.filter_expressiveness import IMAGE_EXTENSIONS
+from utils.instrument import timer
+from utils.parallel import imap_jobs
+
+# PCA radial palette (see pca_radial.ipynb):
+# the colors are projected on their first two principal components,
+# the plane is cut into num_segments equal angular segments around the center
+# and each segment contributes the mean color of the pixels inside it
+
+
+def principal_axes(covariance, n_components=2):
+    """Returns the (n_components, 3) principal axes of a 3x3 covariance matrix."""
+    # eigh returns the eigenvalues in ascending order
+    _, vectors = np.linalg.eigh(covariance)
+    components = vectors[:, ::-1][:, :n_components].T
+    # Same sign convention as sklearn: the largest entry of each component is positive
+    signs = np.sign(components[np.arange(n_components), np.argmax(np.abs(components), axis=1)])
+    return components * signs[:, None]
+
+
+def pca_components(colors, weights=None, n_components=2):
+    """Projects colors on their principal components.
+    Args:
+        colors (n, 3) array
+        weights Optional (n,) array, e.g. the counts of a quantized histogram
+        n_components Number of components to keep
+    Returns:
+        (n, n_components) array of projected colors
+    """
+    mean = np.average(colors, axis=0, weights=weights)
+    centered = colors - mean
+    if weights is None:
+        covariance = centered.T @ centered / len(colors)
+    else:
+        covariance = (centered * weights[:, None]).T @ centered / np.sum(weights)
+    return centered @ principal_axes(covariance, n_components).T
+
+
+def angle_segments(components, center, num_segments):
+    """Returns the angular segment of every projected color around center."""
+    # Calculate angles (starting from x axis)
+    angles = np.arctan2(components[:, 1] - center[1], components[:, 0] - center[0])
+    angles = np.mod(angles, 2 * np.pi)
+
+    # Segment i covers [segment_angles[i], segment_angles[i + 1])
+    segment_angles = np.linspace(0, 2 * np.pi, num_segments, endpoint=False)
+    return np.clip(np.digitize(angles, segment_angles) - 1, 0, num_segments - 1)
+
+
+def segment_palette(segment_weights, segment_sums):
+    """Turns per-segment weights and (num_segments, 3) color sums into a palette."""
+    segment_colors = []
+    for total, segment_sum in zip(segment_weights, segment_sums):
+        if total == 0:
+            continue
+        segment_color = segment_sum / total
+        segment_colors.append({
+            "r": segment_color[0],
+            "g": segment_color[1],
+            "b": segment_color[2]
+        })
+    return segment_colors
+
+
+def extract_color_pca_radial(image, weights=None, num_segments=10):
+    """Extracts a palette of up to num_segments colors ordered by PCA angle.
+    Args:
+        image Path, PIL image, (h, w, 3) image array, (n, 3) color table
+              or utils.superpixels.SuperpixelTable (weighted by the superpixel sizes)
+        weights Optional (n,) weights of a color table, e.g. from quantize_colors
+        num_segments Number of angular segments
+    Returns:
+        List of {"r", "g", "b"} dicts, empty segments are skipped
+    """
+    if hasattr(image, "sizes"):
+        image, weights = image.rgb, image.sizes
+    rgb_array = get_rgb_array(image).astype(np.float64)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)
+
+    components = pca_components(rgb_array, weights)
+    center = np.average(components, axis=0, weights=weights)
+    segments = angle_segments(components, center, num_segments)
+
+    segment_weights = np.bincount(segments, weights=weights, minlength=num_segments)
+    segment_sums = np.column_stack([
+        np.bincount(segments,
+                    weights=rgb_array[:, channel] if weights is None else rgb_array[:, channel] * weights,
+                    minlength=num_segments)
+        for channel in range(3)])
+    return segment_palette(segment_weights, segment_sums)
+
+
+def extract_file(path, num_segments=10, bits=None, cache_dir=None):
+    """Extracts the palette of an image file.
+    Args:
+        path The path of the image.
+        num_segments Number of angular segments
+        bits When set, the palette is computed on a quantized histogram with bits bits
+             per channel (see quantize_colors) instead of on every pixel
+        cache_dir When set, the image is decoded through utils.image_cache with this
+                  disk directory, reusing the decode of an earlier stage
+    """
+    if cache_dir is not None:
+        from utils.image_cache import load_image
+        path = load_image(path, disk_dir=cache_dir)
+    if bits is None:
+        return extract_color_pca_radial(path, num_segments=num_segments)
+    colors, counts = quantize_colors(path, bits=bits)
+    return extract_color_pca_radial(colors, counts, num_segments=num_segments)
+
+
+def iter_palettes(images_dir, num_segments=10, bits=None, workers=None, chunksize=4, cache_dir=None):
+    """Streams decode -> extract over a directory on a process pool.
+    Args:
+        images_dir The directory containing the images.
+        num_segments, bits, cache_dir See extract_file.
+        workers Number of worker processes, defaults to the number of CPUs.
+                1 extracts in the current process.
+        chunksize Number of images sent to a worker at once.
+    Returns:
+        An iterator of (filename, palette) tuples in directory order.
+        Unreadable images are skipped.
+    """
+    from utils.palette_store import default_extract, extract_job
+
+    params = {"num_segments": num_segments, "bits": bits, "cache_dir": cache_dir}
+    jobs = [(default_extract, name, os.path.join(images_dir, name), params)
+            for name in sorted(os.listdir(images_dir))
+            if name.lower().endswith(IMAGE_EXTENSIONS)]
+
+    for name, palette, exc in imap_jobs(extract_job, jobs, workers, chunksize):
+        if exc is not None:
+            print("[Warning] could not extract '%s': %s" % (os.path.join(images_dir, name), exc))
+            continue
+        yield name, palette
+
+
+def write_palettes(palettes, path):
+    """Writes (filename, palette) pairs as a data.json object without holding them all in memory.
+    Returns:
+        Number of palettes written
+    """
+    count = 0
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write("{")
+        for name, palette in palettes:
+            # palettes is often a lazy extraction, only the writing itself is timed
+            with timer("write_json"):
+                if count:
+                    f.write(", ")
+                f.write("%s: %s" % (json.dumps(name), json.dumps(palette)))
+            count += 1
+        f.write("}")
+    os.replace(tmp_path, path)
+    return count
+
+
+def write_output(palettes, path, output_format="json", shards=None, dtype="uint8", space="rgb"):
+    """Writes (filename, palette) pairs in one of the output formats.
+    Args:
+        palettes Iterable of (filename, palette)
+        path Output path, the shard number is added before the extension when sharded
+        output_format "json" (data.json), "compact" (rounded, no whitespace)
+                      or "packed" (binary, see utils.palette_format)
+        shards Optional number of shards, spread by a hash of the image name
+        dtype, space Color storage of the packed format
+    Returns:
+        List of the written paths
+    """
+    from utils import palette_format
+    from utils.palette_store import shard_of
+
+    if output_format == "packed":
+        if shards:
+            return palette_format.write_sharded(palettes, path, shards, dtype, space)
+        palette_format.write_packed(palettes, path, dtype, space)
+        return [path]
+
+    paths = palette_format.shard_paths(path, shards) if shards else [path]
+    parts = [[] for _ in paths]
+    if shards:
+        for name, palette in palettes:
+            parts[shard_of(name, shards)].append((name, palette))
+    elif output_format == "json":
+        # A single data.json is streamed without collecting the palettes
+        write_palettes(palettes, path)
+        return paths
+    else:
+        parts[0] = palettes
+    for part, part_path in zip(parts, paths):
+        if output_format == "compact":
+            palette_format.write_compact_json(part, part_path)
+        else:
+            write_palettes(part, part_path)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract PCA radial palettes of a directory of images into data.json")
+    parser.add_argument("images_dir", help="directory containing the images")
+    parser.add_argument("-o", "--output", default="data.json", help="output file")
+    parser.add_argument("--segments", type=int, default=10, help="number of angular segments")
+    parser.add_argument("--bits", type=int, default=None,
+                        help="extract on a quantized histogram with this many bits per channel")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all CPUs)")
+    parser.add_argument("--cache", default=None,
+                        help="palette store directory, only new or changed images are extracted")
+    parser.add_argument("--decode-cache", default=None,
+                        help="directory of decoded images shared with the other stages")
+    parser.add_argument("--format", default="json", choices=("json", "compact", "packed"), help="output format")
+    parser.add_argument("--shards", type=int, default=None, help="split the output by image name hash")
+    parser.add_argument("--dtype", default="uint8", choices=("uint8", "float16"), help="packed color type")
+    parser.add_argument("--space", default="rgb", choices=("rgb", "lab"), help="packed color space")
+    args = parser.parse_args(argv)
+
+    if args.cache is not None:
+        from utils.palette_store import PaletteStore
+        store = PaletteStore(args.cache, num_segments=args.segments, bits=args.bits)
+        stats = store.refresh(args.images_dir, workers=args.workers)
+        palettes = store.items()
+        print("%d palettes computed, %d cached, %d evicted" % (stats["computed"], stats["cached"], stats["evicted"]))
+    else:
+        palettes = iter_palettes(args.images_dir, args.segments, args.bits, args.workers,
+                                 cache_dir=args.decode_cache)
+
+    paths = write_output(palettes, args.output, args.format, args.shards, args.dtype, args.space)
+    print("Wrote %s" % (", ".join(paths),))
+
+
+if __name__ == "__main__":
+    main()
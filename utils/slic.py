@@ -1,7 +1,9 @@
 import math
-from skimage import io, color
+import os
 import numpy as np
-from tqdm import trange
+
+from utils.color_convert import lab2rgb, rgb2lab
+from utils.instrument import timed, timer
 
 # https://github.com/laixintao/slic-python-implementation/blob/master/slic.py
 # https://github.com/darshitajain/SLIC/blob/master/SLIC_Algorithm.ipynb
@@ -35,6 +37,59 @@ class Cluster(object):
         return self.__str__()
 
 
+def connected_labels(labels, min_size):
+    """
+    Relabel a label map so that every label is one 4-connected region.
+    Connected components are found in one linear pass (skimage.measure.label), then
+    merged as in the raster scan of the SLIC paper: a component smaller than min_size,
+    or of unassigned (-1) pixels, adopts the label of the component the scan met just
+    before it, left of its first pixel (above it in the first column). Only the component
+    at the top-left corner has none and keeps its own label. Larger disconnected
+    fragments of a label become labels of their own.
+    :param labels: (h, w) integer label map, -1 for unassigned pixels
+    :param min_size: smallest component kept on its own
+    :return: (h, w) label map with consecutive labels 0..K'-1, ordered by original label
+    """
+    from skimage.measure import label as label_components
+
+    labels = np.asarray(labels)
+    if labels.size == 0:
+        return labels.astype(np.intp)
+    # -2 never occurs, so unassigned regions get components too
+    components = label_components(labels, background=-2, connectivity=1)
+    flat = components.ravel()
+    n = int(components.max()) + 1
+    sizes = np.bincount(flat, minlength=n)
+    owner = np.full(n, -1, dtype=np.int64)
+    owner[flat] = labels.ravel()
+    # Where the raster scan meets every component (skimage numbers them from 1, 0 is unused)
+    first = np.full(n, flat.size, dtype=np.intp)
+    np.minimum.at(first, flat, np.arange(flat.size))
+
+    small = (sizes < min_size) | (owner < 0)
+    small[0] = False
+    merged = np.flatnonzero(small)
+    y, x = np.divmod(first[merged], labels.shape[1])
+    has_neighbour = (x > 0) | (y > 0)
+    merged, x = merged[has_neighbour], x[has_neighbour]
+    target = np.arange(n)
+    target[merged] = flat[np.where(x > 0, first[merged] - 1, first[merged] - labels.shape[1])]
+    # Each component points at one met earlier, so the chains end at a kept component;
+    # pointer jumping follows a chain of length d in log2(d) passes
+    while True:
+        jumped = target[target]
+        if np.array_equal(jumped, target):
+            break
+        target = jumped
+
+    # Consecutive labels for the kept components, in the order of their original labels
+    roots = np.flatnonzero(target[1:] == np.arange(1, n)) + 1
+    roots = roots[np.lexsort((-sizes[roots], owner[roots]))]
+    new_label = np.full(n, -1, dtype=np.intp)
+    new_label[roots] = np.arange(len(roots))
+    return new_label[target][components]
+
+
 class SLICProcessor(object):
     @staticmethod
     def open_image(path):
@@ -42,8 +97,10 @@ class SLICProcessor(object):
         Return:
             3D array, row col [LAB]
         """
-        rgb = io.imread(path)
-        lab_arr = color.rgb2lab(rgb)
+        from skimage import io
+        with timer("decode"):
+            rgb = io.imread(path)
+        lab_arr = rgb2lab(rgb)
         return lab_arr
 
     @staticmethod
@@ -54,11 +111,12 @@ class SLICProcessor(object):
         :param lab_arr:
         :return:
         """
-        rgb_arr = color.lab2rgb(lab_arr) * 255
+        from skimage import io
+        rgb_arr = lab2rgb(lab_arr) * 255
         io.imsave(path, rgb_arr.astype(np.uint8))
 
 
-    def __init__(self, filename, K, M):
+    def __init__(self, filename, K, M, vectorized=True, pyramid_levels=0, refine_iter=2):
         # K is the number of clusters
         self.K = K
         # M is the compactness factor
@@ -70,7 +128,14 @@ class SLICProcessor(object):
         # allowing color differences to have a larger impact.
         self.M = M
 
-        self.data = self.open_image(filename)
+        # filename can also be an (h, w, 3) LAB array that was decoded elsewhere,
+        # e.g. by utils.image_cache
+        if hasattr(filename, "lab"):
+            filename = np.asarray(filename.lab, dtype=np.float64)
+        if isinstance(filename, np.ndarray):
+            self.data = filename
+        else:
+            self.data = self.open_image(filename)
         self.image_height = self.data.shape[0]
         self.image_width = self.data.shape[1]
 
@@ -92,7 +157,26 @@ class SLICProcessor(object):
         # we initialize it to infinity
         self.dis = np.full((self.image_height, self.image_width), np.inf)
 
+        # vectorized selects the NumPy engine, which keeps the same state in arrays:
+        # centers is a (K, 5) array of [h, w, l, a, b] rows
+        # labels is an (h, w) array of cluster indices (-1 means unassigned)
+        # The per-pixel loop engine (vectorized=False) is kept as a reference
+        self.vectorized = vectorized
+        self.centers = np.empty((0, 5))
+        self.labels = np.full((self.image_height, self.image_width), -1, dtype=np.intp)
+
+        # pyramid_levels > 0 runs SLIC coarse-to-fine (see run_pyramid):
+        # the image is first segmented after downsampling pyramid_levels times by 2,
+        # then only refine_iter rounds run on each finer level
+        # "auto" picks enough levels for the coarsest one to be about one megapixel
+        if pyramid_levels == "auto":
+            pyramid_levels = max(0, int(math.ceil(math.log(max(self.N, 1) / 1e6, 4))))
+        self.pyramid_levels = pyramid_levels
+        self.refine_iter = refine_iter
+
     def init_clusters(self):
+        if self.vectorized:
+            return self.init_centers()
         # we start from the center of each grid
         # h is row
         h = self.S / 2
@@ -129,6 +213,8 @@ class SLICProcessor(object):
         return gradient
 
     def move_clusters(self):
+        if self.vectorized:
+            return self.move_centers()
         for cluster in self.clusters:
             cluster_gradient = self.get_gradient(cluster.h, cluster.w)
             # dh and dw are the offset of the cluster center
@@ -144,7 +230,10 @@ class SLICProcessor(object):
                         cluster_gradient = new_gradient
     
     # In the assignment step, we assign each pixel to the nearest cluster
+    @timed("slic.assignment")
     def assignment(self):
+        if self.vectorized:
+            return self.assign_labels()
         for cluster in self.clusters:
             # Remember that self.S is the edge length of each cluster
             # We loop through the pixels in the cluster's neighborhood
@@ -200,7 +289,10 @@ class SLICProcessor(object):
                         self.dis[h][w] = D
 
     # In the update step, we update the cluster center
+    @timed("slic.update")
     def update_cluster(self):
+        if self.vectorized:
+            return self.update_centers()
         for cluster in self.clusters:
             sum_h = sum_w = number = 0
             # we loop through the pixels in the cluster
@@ -213,12 +305,20 @@ class SLICProcessor(object):
                 sum_h += p[0]
                 sum_w += p[1]
                 number += 1
+            # A cluster that lost all of its pixels keeps its previous center, like set_centers
+            if number == 0:
+                continue
             _h = int(sum_h / number)
             _w = int(sum_w / number)
             cluster.update(_h, _w, self.data[_h][_w][0], self.data[_h][_w][1], self.data[_h][_w][2])
 
-    def save_current_image(self, name):
+    def save_current_image(self, name, directory="test"):
         image_arr = np.copy(self.data)
+        if self.vectorized:
+            assigned = self.labels >= 0
+            image_arr[assigned] = self.centers[self.labels[assigned], 2:]
+            self.save_lab_image(os.path.join(directory, name), image_arr)
+            return
         for cluster in self.clusters:
             for p in cluster.pixels:
                 image_arr[p[0]][p[1]][0] = cluster.l
@@ -228,10 +328,157 @@ class SLICProcessor(object):
             # image_arr[cluster.h][cluster.w][0] = 0
             # image_arr[cluster.h][cluster.w][1] = 0
             # image_arr[cluster.h][cluster.w][2] = 0
-        self.save_lab_image("test/" + name, image_arr)
+        self.save_lab_image(os.path.join(directory, name), image_arr)
 
-    # This is the training process
-    def iterate_10times(self):
+    # The methods below are the NumPy engine used when vectorized is True
+    # They follow the loop engine step by step (same window, same tie-breaking,
+    # same stale distances between iterations), so both engines give the same labels
+    def init_centers(self):
+        # Same grid as init_clusters: S / 2, S / 2 + S, ... truncated to int
+        hs = np.arange(self.S / 2, self.image_height, self.S).astype(int)
+        ws = np.arange(self.S / 2, self.image_width, self.S).astype(int)
+        hh, ww = np.meshgrid(hs, ws, indexing="ij")
+        hh = hh.ravel()
+        ww = ww.ravel()
+        self.centers = np.column_stack((hh, ww, self.data[hh, ww])).astype(np.float64)
+
+    def gradients(self, hs, ws):
+        # Vectorized get_gradient for arrays of positions
+        ws = np.where(ws + 1 >= self.image_width, self.image_width - 2, ws)
+        hs = np.where(hs + 1 >= self.image_height, self.image_height - 2, hs)
+        here = self.data[hs, ws]
+        below_right = self.data[hs + 1, ws + 1]
+        return below_right[:, 0] - here[:, 0] + \
+               below_right[:, 1] - here[:, 1] + \
+               below_right[:, 2] - here[:, 2]
+
+    def move_centers(self):
+        hs = self.centers[:, 0].astype(int)
+        ws = self.centers[:, 1].astype(int)
+        center_gradient = self.gradients(hs, ws)
+        # Offsets are visited in the same order as move_clusters,
+        # each one relative to the (possibly already moved) center
+        for dh in range(-1, 2):
+            for dw in range(-1, 2):
+                _hs = hs + dh
+                _ws = ws + dw
+                new_gradient = self.gradients(_hs, _ws)
+                moved = new_gradient < center_gradient
+                hs = np.where(moved, _hs, hs)
+                ws = np.where(moved, _ws, ws)
+                center_gradient = np.where(moved, new_gradient, center_gradient)
+        self.centers = np.column_stack((hs, ws, self.data[hs, ws])).astype(np.float64)
+
+    def assign_labels(self):
+        window = self.S * 2
+        for k, (ch, cw, cl, ca, cb) in enumerate(self.centers):
+            ch = int(ch)
+            cw = int(cw)
+            h0, h1 = max(ch - window, 0), min(ch + window, self.image_height)
+            w0, w1 = max(cw - window, 0), min(cw + window, self.image_width)
+            if h0 >= h1 or w0 >= w1:
+                continue
+            region = self.data[h0:h1, w0:w1]
+
+            Dc = np.sqrt(
+                (region[:, :, 0] - cl) ** 2 +
+                (region[:, :, 1] - ca) ** 2 +
+                (region[:, :, 2] - cb) ** 2)
+            dh = (np.arange(h0, h1) - ch)[:, None]
+            dw = (np.arange(w0, w1) - cw)[None, :]
+            Ds = np.sqrt(dh ** 2.0 + dw ** 2.0)
+            D = np.sqrt((Dc / self.M) ** 2 + (Ds / self.S) ** 2)
+
+            # dis and labels slices are views, so this writes through
+            dis = self.dis[h0:h1, w0:w1]
+            labels = self.labels[h0:h1, w0:w1]
+            closer = D < dis
+            dis[closer] = D[closer]
+            labels[closer] = k
+
+    def center_sums(self, labels=None, h0=0, w0=0, scale=1):
+        # Pixel count and summed positions of every center
+        # labels, h0, w0 restrict the sums to a block of the label map starting at (h0, w0)
+        # scale > 1 treats every label as a scale x scale block of pixels
+        if labels is None:
+            labels = self.labels
+        assigned = labels >= 0
+        hs, ws = np.nonzero(assigned)
+        labels = labels[assigned]
+        K = len(self.centers)
+        # The positions inside a scale x scale block at (h, w) sum to scale^2 * (scale * h) + scale * (0 + ... + scale - 1)
+        offset = scale * scale * (scale - 1) / 2
+        number = scale * scale * np.bincount(labels, minlength=K)
+        sum_h = np.bincount(labels, weights=scale ** 3 * (hs + h0) + offset, minlength=K)
+        sum_w = np.bincount(labels, weights=scale ** 3 * (ws + w0) + offset, minlength=K)
+        return number, sum_h, sum_w
+
+    def set_centers(self, number, sum_h, sum_w):
+        # A center that lost all of its pixels keeps its previous position
+        filled = number > 0
+        _h = (sum_h[filled] / number[filled]).astype(int)
+        _w = (sum_w[filled] / number[filled]).astype(int)
+        self.centers[filled, 0] = _h
+        self.centers[filled, 1] = _w
+        self.centers[filled, 2:] = self.data[_h, _w]
+
+    def update_centers(self):
+        self.set_centers(*self.center_sums())
+
+    def reset(self):
+        # Forget any previous run so run() always starts from a fresh grid
+        self.clusters = []
+        self.label = {}
+        self.centers = np.empty((0, 5))
+        self.labels.fill(-1)
+        self.dis.fill(np.inf)
+
+    def center_array(self):
+        """
+        Return:
+            (K, 5) array of [h, w, l, a, b] rows for either engine
+        """
+        if self.vectorized:
+            return self.centers.copy()
+        return np.array([[c.h, c.w, c.l, c.a, c.b] for c in self.clusters], dtype=np.float64)
+
+    def label_map(self):
+        """
+        Return:
+            (h, w) array of cluster indices into center_array(), -1 for unassigned pixels
+        """
+        if self.vectorized:
+            return self.labels.copy()
+        labels = np.full((self.image_height, self.image_width), -1, dtype=np.intp)
+        index = {cluster.no: k for k, cluster in enumerate(self.clusters)}
+        for (h, w), cluster in self.label.items():
+            labels[h, w] = index[cluster.no]
+        return labels
+
+    def snapshot_name(self, loop):
+        return 'lenna_M{m}_K{k}_loop{loop}.png'.format(loop=loop, m=self.M, k=self.K)
+
+    def run(self, max_iter=10, tol=0.5, callback=None, snapshot_interval=None, snapshot_dir="test",
+            progress=False, connectivity=False):
+        """
+        Run SLIC until the centers stop moving, keeping everything in memory.
+        :param max_iter: upper bound on the number of assignment/update rounds
+        :param tol: stop once the residual error (mean center movement in pixels) is below tol
+        :param callback: optional callable(processor, loop) invoked after every round
+        :param snapshot_interval: save an image every snapshot_interval rounds (None disables it)
+        :param snapshot_dir: directory the snapshots are written to
+        :param progress: show a tqdm progress bar
+        :param connectivity: finish with enforce_connectivity()
+        :return: (label map, centers) as returned by label_map() and center_array()
+        """
+        if self.pyramid_levels > 0:
+            labels, centers = self.run_pyramid(max_iter, tol, callback)
+            if connectivity:
+                self.enforce_connectivity()
+                return self.label_map(), self.center_array()
+            return labels, centers
+
+        self.reset()
         self.init_clusters()
         # In here we reassign the cluster center
         # this only happens once
@@ -239,11 +486,187 @@ class SLICProcessor(object):
         # if we change the cluster center too much, the spatial information will be lost
         self.move_clusters()
 
-        # Mostly it is known that 10 iterations is enough for slic
-        for i in trange(10):
+        previous = self.center_array()
+        self.residual = np.inf
+        self.n_iter = 0
+        if progress:
+            from tqdm import trange
+            loops = trange(max_iter)
+        else:
+            loops = range(max_iter)
+        for i in loops:
             self.assignment()
             self.update_cluster()
-            name = 'lenna_M{m}_K{k}_loop{loop}.png'.format(loop=i, m=self.M, k=self.K)
-            self.save_current_image(name)
+            self.n_iter = i + 1
+
+            # The residual error is how far the centers moved in this round
+            centers = self.center_array()
+            self.residual = float(np.mean(np.hypot(centers[:, 0] - previous[:, 0],
+                                                   centers[:, 1] - previous[:, 1])))
+            previous = centers
+
+            if callback is not None:
+                callback(self, i)
+            if snapshot_interval and (i + 1) % snapshot_interval == 0:
+                self.save_current_image(self.snapshot_name(i), snapshot_dir)
+            if self.residual < tol:
+                break
+
+        if connectivity:
+            self.enforce_connectivity()
+            return self.label_map(), self.center_array()
+        return self.label_map(), previous
+
+    @timed("slic.pyramid")
+    def run_pyramid(self, max_iter=10, tol=0.5, callback=None):
+        """
+        Coarse-to-fine SLIC: run to convergence on the coarsest level of a pyramid
+        (the image downsampled pyramid_levels times by 2), then go back up one level
+        at a time, using the upsampled centers and labels as the initial state and
+        refining them for refine_iter rounds (see refine_from).
+        :return: (label map, centers) as returned by label_map() and center_array()
+        """
+        if not self.vectorized:
+            raise ValueError("pyramid_levels requires the vectorized engine")
+        pyramid = [self.data]
+        for _ in range(self.pyramid_levels):
+            pyramid.append(self.downsample(pyramid[-1], 2))
+
+        coarse = SLICProcessor(pyramid[-1], self.K, self.M)
+        labels, centers = coarse.run(max_iter, tol)
+        self.n_iter = coarse.n_iter
+
+        self.reset()
+        for lab_arr in reversed(pyramid[:-1]):
+            level = self if lab_arr is self.data else SLICProcessor(lab_arr, self.K, self.M)
+            level.refine_from(labels, centers, self.refine_iter)
+            labels, centers = level.labels, level.centers
+            self.n_iter += self.refine_iter
+        self.residual = level.residual
+
+        if callback is not None:
+            callback(self, self.n_iter - 1)
+        return self.label_map(), self.center_array()
+
+    @staticmethod
+    def downsample(lab_arr, factor):
+        # Mean of each factor x factor block, the bottom/right remainder is dropped
+        h = lab_arr.shape[0] // factor
+        w = lab_arr.shape[1] // factor
+        total = np.zeros((h, w, 3))
+        # Summing strided views is much faster than a reshape(...).mean over the block axes
+        for dh in range(factor):
+            for dw in range(factor):
+                total += lab_arr[dh:h * factor:factor, dw:w * factor:factor]
+        return total / (factor * factor)
+
+    def upsample(self, coarse_arr):
+        # Nearest-neighbour 2x upsampling, the rows/columns dropped by downsample repeat the edge
+        arr = np.repeat(np.repeat(coarse_arr, 2, axis=0), 2, axis=1)
+        pad_h = self.image_height - arr.shape[0]
+        pad_w = self.image_width - arr.shape[1]
+        return np.pad(arr, ((0, pad_h), (0, pad_w)), mode="edge")
+
+    def refine_from(self, coarse_labels, coarse_centers, rounds):
+        """
+        Initialize from the segmentation of the next coarser pyramid level and refine it.
+        Superpixels do not move much between levels, so only pixels whose coarse parent
+        touches another superpixel (the boundary band) are reassigned, each one to the closest
+        of the centers of its parent and the parent's 4 neighbours. The other pixels keep
+        their upsampled label and the center sums are updated incrementally, so a round
+        costs O(band) instead of the O(N * window) of assignment().
+        """
+        hs = np.minimum((coarse_centers[:, 0] * 2 + 1).astype(int), self.image_height - 1)
+        ws = np.minimum((coarse_centers[:, 1] * 2 + 1).astype(int), self.image_width - 1)
+        self.centers = np.column_stack((hs, ws, self.data[hs, ws])).astype(np.float64)
+        self.labels[:] = self.upsample(coarse_labels)
+
+        # Offsets into the padded coarse labels: the parent itself, then up, down, left, right
+        offsets = ((1, 1), (0, 1), (2, 1), (1, 0), (1, 2))
+        ch, cw = coarse_labels.shape
+        padded = np.pad(coarse_labels, 1, mode="edge")
+        boundary = np.zeros((ch, cw), dtype=bool)
+        for dh, dw in offsets[1:]:
+            boundary |= padded[dh:dh + ch, dw:dw + cw] != coarse_labels
+
+        band_h, band_w = np.nonzero(self.upsample(boundary))
+        parent_h = np.minimum(band_h // 2, ch - 1)
+        parent_w = np.minimum(band_w // 2, cw - 1)
+        candidates = np.stack([padded[parent_h + dh, parent_w + dw] for dh, dw in offsets], axis=1)
+        # Unassigned coarse pixels (-1) are not candidates
+        unassigned = candidates < 0
+        candidates = np.maximum(candidates, 0)
+        colors = self.data[band_h, band_w].astype(np.float32)
+        band_hf = band_h.astype(np.float32)[:, None]
+        band_wf = band_w.astype(np.float32)[:, None]
+        rows = np.arange(len(band_h))
+
+        # The upsampled labels are 2 x 2 copies of the coarse ones, plus the edge rows/columns
+        K = len(self.centers)
+        number, sum_h, sum_w = self.center_sums(coarse_labels, scale=2)
+        for h0, w0 in ((2 * ch, 0), (0, 2 * cw)):
+            block = self.labels[h0:, w0:] if h0 else self.labels[:2 * ch, w0:]
+            extra = self.center_sums(block, h0, w0)
+            number += extra[0]
+            sum_h += extra[1]
+            sum_w += extra[2]
+        self.residual = np.inf
+        for _ in range(rounds):
+            previous = self.centers.copy()
+            center = self.centers.astype(np.float32)
+            Dc2 = (colors[:, 0:1] - center[candidates, 2]) ** 2 + \
+                  (colors[:, 1:2] - center[candidates, 3]) ** 2 + \
+                  (colors[:, 2:3] - center[candidates, 4]) ** 2
+            Ds2 = (band_hf - center[candidates, 0]) ** 2 + (band_wf - center[candidates, 1]) ** 2
+            D2 = Dc2 / self.M ** 2 + Ds2 / self.S ** 2
+            D2[unassigned] = np.inf
+            best = candidates[rows, np.argmin(D2, axis=1)]
 
+            # Move the pixels that changed label from their old center's sums to the new one
+            old = self.labels[band_h, band_w]
+            moved = old != best
+            moved_h = band_h[moved]
+            moved_w = band_w[moved]
+            self.labels[moved_h, moved_w] = best[moved]
+            for labels, sign, keep in ((old[moved], -1, old[moved] >= 0), (best[moved], 1, slice(None))):
+                number += sign * np.bincount(labels[keep], minlength=K)
+                sum_h += sign * np.bincount(labels[keep], weights=moved_h[keep], minlength=K)
+                sum_w += sign * np.bincount(labels[keep], weights=moved_w[keep], minlength=K)
+            self.set_centers(number, sum_h, sum_w)
+            self.residual = float(np.mean(np.hypot(self.centers[:, 0] - previous[:, 0],
+                                                   self.centers[:, 1] - previous[:, 1])))
 
+    @timed("slic.connectivity")
+    def enforce_connectivity(self, min_size=None):
+        """
+        Make every superpixel one connected region (see connected_labels): stray fragments
+        and unassigned pixels are merged into a neighbour, and clusters left without
+        pixels are dropped. The centers are recomputed from the new labels.
+        :param min_size: fragments smaller than this are merged, defaults to a quarter
+                         of the expected superpixel size (S * S / 4)
+        """
+        if min_size is None:
+            min_size = max(1, self.S * self.S // 4)
+        labels = connected_labels(self.label_map(), min_size)
+        K = int(labels.max()) + 1 if labels.size else 0
+
+        self.centers = np.zeros((K, 5))
+        self.labels = labels
+        self.set_centers(*self.center_sums())
+        self.dis.fill(np.inf)
+        if not self.vectorized:
+            # Rebuild the loop engine state from the arrays
+            self.clusters = [self.make_cluster(h, w) for h, w in self.centers[:, :2]]
+            self.label = {}
+            for cluster in self.clusters:
+                cluster.pixels = []
+            hs, ws = np.nonzero(labels >= 0)
+            for h, w, k in zip(hs.tolist(), ws.tolist(), labels[hs, ws].tolist()):
+                self.label[(h, w)] = self.clusters[k]
+                self.clusters[k].pixels.append((h, w))
+
+    # This is the training process
+    def iterate_10times(self):
+        # Mostly it is known that 10 iterations is enough for slic
+        # This keeps the original behaviour: 10 rounds with a snapshot after each one
+        self.run(max_iter=10, tol=0, snapshot_interval=1, progress=True)
@@ -0,0 +1,201 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from utils.filter_expressiveness import IMAGE_EXTENSIONS
+from utils.instrument import image_context
+from utils.palette_store import write_json_atomic
+from utils.parallel import imap_jobs
+from utils.superpixels import superpixel_stats, table_from_stats
+
+# Batch SLIC over a directory. Workers write their results straight into .npy files
+# and only send a few numbers back, so no image-sized array goes through a pipe:
+#   <name>.labels.npy       (h, w) int32 label map, one connected region per label
+#                           (-1 for pixels no cluster reached with --no-connectivity)
+#   <name>.superpixels.npy  (K, 6) float32 superpixel_stats: mean h, w, L, a, b and pixel count
+#   index.json              image name -> shape, superpixel count, iterations, seconds,
+#                           files, the segmentation options and the image size and mtime
+# <name> is the full image file name, so sky.jpg and sky.png do not share outputs.
+# index.json is rewritten every INDEX_FLUSH images and when the run stops, even on an
+# interrupt, and a re-run only skips images segmented with the same options whose size and
+# mtime are unchanged (as utils.palette_store does before re-hashing), so a file replaced
+# under the same name is segmented again.
+# load_segmentation() opens both arrays memory-mapped.
+
+INDEX_FLUSH = 16
+
+
+def _save_npy(path, array):
+    # Filled through a memory map under a temporary name, then renamed into place
+    tmp_path = path[:-len(".npy")] + ".tmp.npy"
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=array.dtype, shape=array.shape)
+    out[...] = array
+    out.flush()
+    del out
+    os.replace(tmp_path, path)
+
+
+def output_paths(out_dir, name):
+    stem = os.path.join(out_dir, name)
+    return stem + ".labels.npy", stem + ".superpixels.npy"
+
+
+def segment_file(path, out_dir, K, M, max_iter=10, tol=0.5, max_size=None, pyramid_levels=0, connectivity=True,
+                 cache_dir=None):
+    """Segments one image and writes its label map and superpixel table to out_dir.
+    Args:
+        cache_dir When set, the image is decoded through utils.image_cache with this disk
+                  directory, reusing the decode of the other stages.
+    Returns:
+        Dict with the "shape", the "count" of non-empty superpixels, "iterations" and "seconds"
+    """
+    from utils.slic import SLICProcessor
+
+    start = time.perf_counter()
+    if cache_dir is not None:
+        from utils.image_cache import load_image
+        decoded = load_image(path, max_size, cache_dir)
+    else:
+        from utils.image_cache import decode_image
+        decoded = decode_image(path, max_size)
+    processor = SLICProcessor(decoded, K, M, pyramid_levels=pyramid_levels)
+    labels, centers = processor.run(max_iter=max_iter, tol=tol, connectivity=connectivity)
+    stats = superpixel_stats(labels, decoded.lab, len(centers)).astype(np.float32)
+
+    labels_path, superpixels_path = output_paths(out_dir, os.path.basename(path))
+    _save_npy(labels_path, labels.astype(np.int32))
+    _save_npy(superpixels_path, stats)
+    return {
+        "shape": list(labels.shape),
+        "count": int(np.count_nonzero(stats[:, 5])),
+        "iterations": processor.n_iter,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def _segment_job(job):
+    name, path, out_dir, options, cache_dir, source = job
+    try:
+        with image_context(name):
+            info = segment_file(path, out_dir, cache_dir=cache_dir, **options)
+            info.update(source)
+            return name, info, None
+    except Exception as exc:
+        # One bad image must not take the batch down with it
+        return name, None, "%s: %s" % (type(exc).__name__, exc)
+
+
+def segment_directory(images_dir, out_dir, K=200, M=30, max_iter=10, tol=0.5, max_size=None,
+                      pyramid_levels=0, connectivity=True, workers=None, overwrite=False, progress=True,
+                      cache_dir=None):
+    """Segments every image of a directory on a process pool.
+    Args:
+        images_dir The directory containing the images.
+        out_dir The directory the .npy outputs and index.json are written to.
+        K, M, max_iter, tol, pyramid_levels, connectivity See SLICProcessor and SLICProcessor.run.
+        max_size Longest side the images are decoded at, None for full resolution.
+        workers Number of worker processes, defaults to the number of CPUs.
+                1 segments in the current process.
+        overwrite Segment again images whose outputs already exist.
+        progress Show a tqdm progress bar.
+        cache_dir Decode cache directory, see segment_file.
+    Returns:
+        (index, failures): the index.json entries of the segmented images and
+        a dict image name -> error message of the images that failed
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    index_path = os.path.join(out_dir, "index.json")
+    index = {}
+    if os.path.isfile(index_path) and not overwrite:
+        with open(index_path) as f:
+            index = json.load(f)
+
+    options = {"K": K, "M": M, "max_iter": max_iter, "tol": tol, "max_size": max_size,
+               "pyramid_levels": pyramid_levels, "connectivity": connectivity}
+    jobs = []
+    for name in sorted(os.listdir(images_dir)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        path = os.path.join(images_dir, name)
+        stat = os.stat(path)
+        # Taken before segmenting, so a file changed meanwhile is segmented again next time
+        source = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+        entry = index.get(name)
+        if entry is not None and entry.get("options") == options and \
+                all(entry.get(key) == value for key, value in source.items()) and \
+                all(os.path.isfile(p) for p in output_paths(out_dir, name)):
+            continue
+        jobs.append((name, path, out_dir, options, cache_dir, source))
+
+    failures = {}
+    try:
+        _collect(imap_jobs(_segment_job, jobs, workers, ordered=False), len(jobs), index, failures, progress,
+                 options, index_path)
+    finally:
+        # Also on an interrupt, so the next run resumes after the images already done
+        write_json_atomic(index_path, index, indent=1, sort_keys=True)
+    return index, failures
+
+
+def _collect(results, total, index, failures, progress, options, index_path):
+    if progress:
+        from tqdm import tqdm
+        results = tqdm(results, total=total, unit="image")
+    for i, (name, info, error) in enumerate(results, 1):
+        if error is not None:
+            print("[Warning] could not segment '%s': %s" % (name, error))
+            failures[name] = error
+            continue
+        labels_path, superpixels_path = output_paths("", name)
+        info["labels"] = labels_path
+        info["superpixels"] = superpixels_path
+        info["options"] = options
+        index[name] = info
+        if i % INDEX_FLUSH == 0:
+            write_json_atomic(index_path, index, indent=1, sort_keys=True)
+
+
+def load_segmentation(out_dir, name):
+    """Returns the memory-mapped (labels, superpixel stats) arrays written for an image."""
+    labels_path, superpixels_path = output_paths(out_dir, name)
+    return np.load(labels_path, mmap_mode="r"), np.load(superpixels_path, mmap_mode="r")
+
+
+def load_superpixel_table(out_dir, name):
+    """Returns the SuperpixelTable of a segmented image, ready for a palette extractor."""
+    return table_from_stats(load_segmentation(out_dir, name)[1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Segment a directory of images with SLIC")
+    parser.add_argument("images_dir", help="directory containing the images")
+    parser.add_argument("out_dir", help="directory of the label maps and superpixel tables")
+    parser.add_argument("-K", type=int, default=200, help="number of superpixels")
+    parser.add_argument("-M", type=float, default=30, help="compactness")
+    parser.add_argument("--max-iter", type=int, default=10)
+    parser.add_argument("--max-size", type=int, default=None, help="decode at most this many pixels per side")
+    parser.add_argument("--pyramid-levels", default=0,
+                        type=lambda value: value if value == "auto" else int(value),
+                        help="coarse-to-fine levels, or auto")
+    parser.add_argument("--no-connectivity", action="store_true",
+                        help="keep stray fragments and unassigned pixels (see SLICProcessor.enforce_connectivity)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all CPUs)")
+    parser.add_argument("--overwrite", action="store_true", help="segment images that already have outputs")
+    parser.add_argument("--decode-cache", default=None,
+                        help="directory of decoded images shared with the other stages")
+    args = parser.parse_args(argv)
+
+    index, failures = segment_directory(args.images_dir, args.out_dir, args.K, args.M, args.max_iter,
+                                        max_size=args.max_size, pyramid_levels=args.pyramid_levels,
+                                        connectivity=not args.no_connectivity,
+                                        workers=args.workers, overwrite=args.overwrite,
+                                        cache_dir=args.decode_cache)
+    print("%d images segmented in %s, %d failed" % (len(index), args.out_dir, len(failures)))
+
+
+if __name__ == "__main__":
+    main()
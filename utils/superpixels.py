@@ -0,0 +1,130 @@
+from collections import namedtuple
+
+import numpy as np
+
+from utils.color_convert import lab2rgb
+
+# Superpixel table of a SLIC label map, one row per non-empty superpixel:
+#   positions (n, 2) mean (h, w) pixel position
+#   lab       (n, 3) mean CIELAB color
+#   rgb       (n, 3) mean 0-255 RGB color
+#   sizes     (n,)   number of pixels, the weight of the row
+# A few hundred rows summarize a sky photo, and Custom_KMeans.fit and
+# extract_color_pca_radial accept the table directly, weighted by sizes.
+SuperpixelTable = namedtuple("SuperpixelTable", ["positions", "lab", "rgb", "sizes"])
+
+
+def superpixel_stats(labels, lab, n_labels=None):
+    """Returns the (n_labels, 6) array [h, w, l, a, b, count] of every label, laid out
+    like SLICProcessor.center_array() plus the pixel count. Pixels labeled -1 are ignored
+    and empty labels have a zero row.
+    """
+    labels = np.asarray(labels)
+    height, width = labels.shape
+    flat_labels = labels.ravel()
+    assigned = flat_labels >= 0
+    if n_labels is None:
+        n_labels = int(flat_labels.max()) + 1 if assigned.any() else 0
+    flat_labels = flat_labels[assigned]
+
+    counts = np.bincount(flat_labels, minlength=n_labels).astype(np.float64)
+    rows = np.broadcast_to(np.arange(height, dtype=np.float64)[:, None], (height, width)).ravel()[assigned]
+    cols = np.broadcast_to(np.arange(width, dtype=np.float64)[None, :], (height, width)).ravel()[assigned]
+    flat_lab = np.asarray(lab).reshape(-1, 3)[assigned]
+    columns = [rows, cols, flat_lab[:, 0], flat_lab[:, 1], flat_lab[:, 2]]
+
+    stats = np.zeros((n_labels, 6))
+    filled = counts > 0
+    for i, values in enumerate(columns):
+        stats[filled, i] = np.bincount(flat_labels, weights=values, minlength=n_labels)[filled] / counts[filled]
+    stats[:, 5] = counts
+    return stats
+
+
+def table_from_stats(stats, rgb=None):
+    """Builds a SuperpixelTable from a superpixel_stats array, dropping the empty labels.
+    Args:
+        rgb Optional (n_labels, 3) mean RGB colors, converted from the LAB means otherwise
+    """
+    stats = np.asarray(stats, dtype=np.float64)
+    filled = stats[:, 5] > 0
+    lab = stats[filled, 2:5]
+    if rgb is None:
+        rgb = lab2rgb(lab).astype(np.float64) * 255
+    else:
+        rgb = np.asarray(rgb, dtype=np.float64)[filled]
+    return SuperpixelTable(stats[filled, 0:2], lab, rgb, stats[filled, 5])
+
+
+def superpixel_table(labels, lab, rgb=None):
+    """Builds the SuperpixelTable of a label map.
+    Args:
+        labels (h, w) label map, e.g. from SLICProcessor.run
+        lab (h, w, 3) LAB image the labels were computed on
+        rgb Optional (h, w, 3) 0-255 RGB image, for exact mean RGB colors
+    """
+    stats = superpixel_stats(labels, lab)
+    rgb_means = None
+    if rgb is not None:
+        flat_labels = np.asarray(labels).ravel()
+        assigned = flat_labels >= 0
+        flat_rgb = np.asarray(rgb).reshape(-1, 3)[assigned]
+        counts = np.maximum(stats[:, 5], 1)
+        rgb_means = np.column_stack([
+            np.bincount(flat_labels[assigned], weights=flat_rgb[:, channel], minlength=len(stats)) / counts
+            for channel in range(3)])
+    return table_from_stats(stats, rgb_means)
+
+
+def color_direction(positions, values, weights=None):
+    """Returns the unit (h, w) direction along which values (e.g. the lightness) change
+    the most, from a weighted least-squares plane fit. It points downwards (or to the
+    right when the change is horizontal), so skies read from zenith to horizon.
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    weights = np.ones(len(positions)) if weights is None else np.asarray(weights, dtype=np.float64)
+    design = np.column_stack((positions - np.average(positions, axis=0, weights=weights), np.ones(len(positions))))
+    root = np.sqrt(weights)[:, None]
+    gradient = np.linalg.lstsq(design * root, np.asarray(values, dtype=np.float64) * root[:, 0], rcond=None)[0][:2]
+    norm = np.hypot(*gradient)
+    if norm == 0:
+        return np.array([1.0, 0.0])
+    direction = gradient / norm
+    if direction[0] < 0 or (direction[0] == 0 and direction[1] < 0):
+        direction = -direction
+    return direction
+
+
+def kmeans_palette(table, n_colors=5, random_state=None, direction=None):
+    """Clusters the superpixels into a palette ordered by where its colors are in the image.
+    Args:
+        table SuperpixelTable
+        n_colors Number of palette colors
+        random_state Seed of Custom_KMeans
+        direction Unit (h, w) direction the colors are ordered along,
+                  defaults to the direction of the lightness change (see color_direction)
+    Returns:
+        List of {"r", "g", "b"} dicts, as the other palette extractors
+    """
+    from utils.custom_kmeans import Custom_KMeans
+
+    kmeans = Custom_KMeans(min(n_colors, len(table.sizes)), random_state=random_state, init="k-means++")
+    kmeans.fit(table)
+    n_clusters = len(kmeans.cluster_centers_)
+    weights = np.bincount(kmeans.labels_, weights=table.sizes, minlength=n_clusters)
+    used = weights > 0
+    positions = np.column_stack([
+        np.bincount(kmeans.labels_, weights=table.positions[:, axis] * table.sizes, minlength=n_clusters)
+        for axis in range(2)])[used] / weights[used, None]
+    colors = lab2rgb(kmeans.cluster_centers_[used]).astype(np.float64) * 255
+
+    if direction is None:
+        direction = color_direction(table.positions, table.lab[:, 0], table.sizes)
+    order = np.argsort(positions @ direction, kind="stable")
+    return [{"r": c[0], "g": c[1], "b": c[2]} for c in colors[order]]
+
+
+def pca_radial_palette(table, num_segments=10):
+    """PCA radial palette of the superpixel mean colors weighted by their sizes."""
+    from utils.pca_radial import extract_color_pca_radial
+    return extract_color_pca_radial(table, num_segments=num_segments)